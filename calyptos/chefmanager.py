@@ -1,8 +1,20 @@
+from StringIO import StringIO
+import base64
+from contextlib import contextmanager
 import glob
 from fabric.contrib.project import rsync_project
+import gzip
+import hashlib
 import json
+import multiprocessing
+from multiprocessing import cpu_count
 from os.path import splitext
 import os
+import time
+from calyptos.files import content_hash, file_hash
+from calyptos.parallel import FABRIC_LOCK
+from calyptos.transfer import transfer_stats
+from calyptos.workspace import Workspace
 
 from fabric.api import *
 from fabric.colors import *
@@ -25,35 +37,221 @@ class FailedToFindNodeException(Exception):
     pass
 
 
+def node_addresses(node_info):
+    # Every address ohai found on the node, its primary address first
+    auto = node_info['automatic']
+    addrs = [auto['ipaddress']]
+    network = auto.get('network')
+    if network:
+        interfaces = network.get('interfaces')
+        for interface, i_info in interfaces.iteritems():
+            for address in i_info.get('addresses', {}):
+                addrs.append(address)
+    return addrs
+
+
+def store_node_file(output, local_hostname, chef_repo_dir, known_nodes):
+    """
+    Write a node file fetched by read_node_file and return its name and
+    compacted contents, or None if the host has no node file for us or it
+    is unchanged and already in known_nodes
+    """
+    lines = output.splitlines()
+    if len(lines) < 2 or lines[0] == local_hostname:
+        return None
+    node_name, digest = lines[0].strip(), lines[1].strip()
+    local_path = chef_repo_dir + 'nodes/' + node_name + '.json'
+    if len(lines) == 2:
+        # Unchanged since we last pulled it
+        if node_name in known_nodes:
+            return None
+        with open(local_path) as handle:
+            return node_name, NodeStore.compact(json.loads(handle.read()))
+    compressed = base64.b64decode(''.join(lines[2:]))
+    data = gzip.GzipFile(fileobj=StringIO(compressed)).read()
+    if hashlib.md5(data).hexdigest() != digest:
+        raise ValueError('Checksum mismatch for ' + local_path)
+    with open(local_path + '.part', 'w') as handle:
+        handle.write(data)
+    os.rename(local_path + '.part', local_path)
+    return node_name, NodeStore.compact(json.loads(data))
+
+
+class NodeStore(object):
+    """
+    Chef node files kept in compact form: every section except the ohai
+    'automatic' tree, plus an index of the node addresses. The automatic
+    attributes stay on disk and are only read when asked for.
+    """
+
+    def __init__(self, chef_repo_dir='chef-repo/'):
+        self.chef_repo_dir = chef_repo_dir
+        self._nodes = {}
+        self._node_addresses = {}
+        self._addresses = {}
+        self._mtimes = {}
+
+    @staticmethod
+    def compact(node_info):
+        # The (sections, addresses) that are kept in memory for a node
+        sections = dict((key, value) for key, value in node_info.iteritems()
+                        if key != 'automatic')
+        return sections, node_addresses(node_info)
+
+    def node_file(self, node_name):
+        return self.chef_repo_dir + 'nodes/' + node_name + '.json'
+
+    def add(self, node_name, compacted, mtime=None):
+        sections, addresses = compacted
+        for address in self._node_addresses.get(node_name, []):
+            if self._addresses.get(address) == node_name:
+                del self._addresses[address]
+        for address in addresses:
+            self._addresses[address] = node_name
+        self._nodes[node_name] = sections
+        self._node_addresses[node_name] = addresses
+        self._mtimes[node_name] = mtime
+
+    def update(self, nodes):
+        for node_name, compacted in nodes.iteritems():
+            node_file = self.node_file(node_name)
+            mtime = None
+            if os.path.isfile(node_file):
+                mtime = os.path.getmtime(node_file)
+            self.add(node_name, compacted, mtime)
+
+    def touch(self, node_name, mtime):
+        # The node's file was rewritten from what is held in memory
+        if node_name in self._nodes:
+            self._mtimes[node_name] = mtime
+
+    def is_current(self, node_name, mtime):
+        return node_name in self._nodes and self._mtimes[node_name] == mtime
+
+    def node_for_address(self, address):
+        return self._addresses.get(address)
+
+    def automatic(self, node_name):
+        with open(self.node_file(node_name)) as handle:
+            return json.loads(handle.read()).get('automatic', {})
+
+    def full(self, node_name):
+        # The complete node, with the automatic attributes read from disk
+        node_info = dict(self._nodes[node_name])
+        if os.path.isfile(self.node_file(node_name)):
+            node_info['automatic'] = self.automatic(node_name)
+        return node_info
+
+    def __getitem__(self, node_name):
+        return self._nodes[node_name]
+
+    def __contains__(self, node_name):
+        return node_name in self._nodes
+
+    def __iter__(self):
+        return iter(self._nodes)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def iteritems(self):
+        return self._nodes.iteritems()
+
+
 class ChefManager():
     CHEF_VERSION = "11.16.4"
 
-    def __init__(self, password, environment_name, hosts, debug=False):
-        env.password = password
-        env.user = 'root'
-        env.parallel = True
-        env.pool_size = 20
-        env.disable_known_hosts = True
+    def __init__(self, password, environment_name, hosts, debug=False,
+                 workspace=None):
+        # Fabric settings for this deployment, applied around each execute
+        # rather than left set on Fabric's env for the life of the process
+        self.fabric_env = {'password': password,
+                           'user': 'root',
+                           'parallel': True,
+                           'pool_size': 20,
+                           'disable_known_hosts': True}
         self.environment_name = environment_name
-        self.current_path, self.folder_name = os.path.split(os.getcwd())
-        self.remote_folder_path = '/root/' + self.folder_name + '/'
+        self.workspace = workspace or Workspace(environment_name)
+        self.chef_repo_dir = self.workspace.chef_repo_dir
+        self.remote_folder_path = self.workspace.remote_folder_path
         self.ssh_opts = "-o StrictHostKeyChecking=no"
-        self.node_hash = {}
+        self.node_hash = NodeStore(self.chef_repo_dir)
         self.hidden_outputs = ['running', 'stdout', 'stderr']
         with hide(*self.hidden_outputs):
             self.local_hostname = local('hostname', capture=True)
-            self.remote_hostnames = execute(run, 'hostname', hosts=hosts)
+            self.remote_hostnames = self.execute(run, 'hostname', hosts=hosts)
+
+    @contextmanager
+    def context(self):
+        # settings() changes Fabric's single, global env while it is in
+        # effect, so executes of deployments sharing a process take turns
+        with FABRIC_LOCK:
+            with settings(**self.fabric_env):
+                yield
+
+    def execute(self, task, *args, **kwargs):
+        # Execute a task within this deployment's Fabric settings
+        with self.context():
+            return execute(task, *args, **kwargs)
+
+    @staticmethod
+    def public_key():
+        with open(os.path.expanduser("~/.ssh/id_rsa.pub")) as key_file:
+            return key_file.read().strip()
+
+    def probe_readiness(self, pub_key):
+        # Task that checks everything prepare sets up on a host in one go
+        command = ("k=0; grep -qF '{0}' /root/.ssh/authorized_keys "
+                   "2>/dev/null && k=1; echo key=$k; "
+                   "r=0; command -v rsync >/dev/null 2>&1 && r=1; "
+                   "echo rsync=$r; "
+                   "echo chef=$(chef-client -v 2>/dev/null | awk '{{print $2}}'); "
+                   "c=0; [ -f {1}chef-repo/nodes/$(hostname).json ] && c=1; "
+                   "echo converged=$c; "
+                   "echo environment=$(sha1sum < {1}chef-repo/environments/"
+                   "{2}.json 2>/dev/null | cut -c1-40)".format(
+                       pub_key, self.remote_folder_path,
+                       self.environment_name))
+        with hide(*self.hidden_outputs):
+            return run(command, pty=False, warn_only=True)
 
     @staticmethod
-    def sync_ssh_key(hosts, debug=False):
+    def parse_readiness(output):
+        fields = dict(line.strip().split('=', 1)
+                      for line in str(output or '').splitlines()
+                      if '=' in line)
+        return {'key': fields.get('key') == '1',
+                'rsync': fields.get('rsync') == '1',
+                'chef_version': fields.get('chef') or None,
+                'converged': fields.get('converged') == '1',
+                'environment_hash': fields.get('environment') or None}
+
+    def readiness(self, hosts):
+        """
+        Probe hosts in one round-trip each and return {host: {'key': bool,
+        'rsync': bool, 'chef_version': version or None, 'converged': bool,
+        'environment_hash': hash of the pushed environment or None}}
+        """
+        outputs = self.execute(self.probe_readiness, self.public_key(),
+                               hosts=hosts)
+        return dict((host, self.parse_readiness(outputs.get(host)))
+                    for host in hosts)
+
+    def has_local_node(self, host):
+        try:
+            self.get_node_name_by_ip(host)
+        except FailedToFindNodeException:
+            return False
+        return True
+
+    def sync_ssh_key(self, hosts, debug=False):
         info('Syncing SSH keys with system under deployment')
         if debug:
             hidden_outputs = []
         else:
             hidden_outputs = ['running', 'stdout', 'stderr']
         with hide(*hidden_outputs):
-            pub_key = local('cat ' + os.path.expanduser("~/.ssh/id_rsa.pub"),
-                            capture=True)
+            pub_key = self.public_key()
             cmd = ("yum install rsync -y --nogpg;"
                    "mkdir -p /root/.ssh;"
                    "chmod 0600 /root/.ssh;"
@@ -61,7 +259,7 @@ class ChefManager():
                    "chmod 0644 /root/.ssh/authorized_keys;"
                    "grep '{0}' /root/.ssh/authorized_keys || echo '{0}' >> /root/.ssh/authorized_keys".format(pub_key))
             info('Running command: {0}'.format(cmd))
-            execute(run, cmd, hosts=hosts)
+            self.execute(run, cmd, hosts=hosts)
 
     @staticmethod
     def install_chef_dk(version='0.6.0', debug=False):
@@ -75,20 +273,38 @@ class ChefManager():
                                                  'sudo bash -s -- -P chefdk -v ' + version)
 
     @staticmethod
-    def create_chef_repo(debug=False):
+    def create_chef_repo(chef_repo_dir='chef-repo/', debug=False):
         info('Creating Chef repository')
         if debug:
             hidden_outputs = []
         else:
             hidden_outputs = ['running', 'stdout', 'stderr']
         with hide(*hidden_outputs):
-            local('chef generate app chef-repo')
-            local('mkdir -p chef-repo/environments')
-            local('mkdir -p chef-repo/nodes')
+            local('chef generate app ' + chef_repo_dir.rstrip('/'))
+            local('mkdir -p ' + chef_repo_dir + 'environments')
+            local('mkdir -p ' + chef_repo_dir + 'nodes')
+
+    @staticmethod
+    def cookbooks_key(berksfile):
+        # What berks vendor produces from: the checkout's HEAD and its
+        # Berksfile and Berksfile.lock
+        with hide('everything'):
+            head = local('cd {0} && git rev-parse HEAD'.format(
+                os.path.dirname(berksfile) or '.'), capture=True)
+        return content_hash('{0} {1} {2}'.format(
+            head, file_hash(berksfile), file_hash(berksfile + '.lock')))
 
     @staticmethod
     def download_cookbooks(berksfile, cookbook_path='chef-repo/cookbooks',
-                           debug=False):
+                           debug=False, stamp_file=None):
+        # stamp_file records what the cookbooks were vendored from, they
+        # are left untouched while that is unchanged
+        if (stamp_file and os.path.isdir(cookbook_path) and
+                os.path.isfile(stamp_file)):
+            with open(stamp_file) as stamp:
+                if stamp.read() == ChefManager.cookbooks_key(berksfile):
+                    info('Chef cookbooks are up to date')
+                    return
         info('Downloading Chef cookbooks')
         if debug:
             hidden_outputs = []
@@ -98,46 +314,51 @@ class ChefManager():
             local('rm -rf {0}'.format(cookbook_path))
             local('berks vendor --berksfile {0} {1}'.format(berksfile,
                                                             cookbook_path))
+        if stamp_file:
+            # After vendoring, which may have written the Berksfile.lock
+            with open(stamp_file, 'w') as stamp:
+                stamp.write(ChefManager.cookbooks_key(berksfile))
 
-    def load_local_node_info(self, chef_repo_dir='chef-repo/'):
+    def load_local_node_info(self, chef_repo_dir=None):
+        chef_repo_dir = chef_repo_dir or self.chef_repo_dir
         for node_file in glob.glob(chef_repo_dir + 'nodes/*.json'):
             self.read_node_hash(node_file)
 
     def read_node_hash(self, node_file):
+        node_name = splitext(node_file.split('/')[-1])[0]
+        mtime = os.path.getmtime(node_file)
+        if self.node_hash.is_current(node_name, mtime):
+            return
         with open(node_file) as handle:
             data = handle.read()
-            node_name = splitext(node_file.split('/')[-1])[0]
             try:
-                self.node_hash[node_name] = json.loads(data)
+                compacted = NodeStore.compact(json.loads(data))
             except ValueError, e:
                 print 'Unable to read: ' + node_name
                 raise e
+            self.node_hash.add(node_name, compacted, mtime)
 
-    def write_node_hash(self, node_name, chef_repo_dir='chef-repo/'):
+    def write_node_hash(self, node_name, chef_repo_dir=None):
+        chef_repo_dir = chef_repo_dir or self.chef_repo_dir
         node_json = chef_repo_dir + 'nodes/' + node_name + '.json'
-        node_info = json.dumps(self.node_hash[node_name], indent=4,
+        node_info = json.dumps(self.node_hash.full(node_name), indent=4,
                                sort_keys=True, separators=(',', ': '))
-        with open(node_json, 'w') as env_json:
+        with open(node_json + '.part', 'w') as env_json:
             env_json.write(node_info)
+        os.rename(node_json + '.part', node_json)
+        if node_json == self.node_hash.node_file(node_name):
+            # Otherwise the next load would parse the file just written
+            self.node_hash.touch(node_name, os.path.getmtime(node_json))
 
     def get_node_name_by_ip(self, target_address):
-        for node, node_info in self.node_hash.iteritems():
-            #ipaddress = node_info['automatic']['ipaddress']
-            if target_address in self.get_node_address_list(node_info):
-                return node_info['name']
-        raise FailedToFindNodeException("Unable to find node: " +
-                                        target_address)
+        node_name = self.node_hash.node_for_address(target_address)
+        if node_name is None:
+            raise FailedToFindNodeException("Unable to find node: " +
+                                            target_address)
+        return node_name
 
     def get_node_address_list(self, node_info):
-        auto = node_info['automatic']
-        addrs = [auto['ipaddress']]
-        network = auto.get('network')
-        if network:
-            interfaces = network.get('interfaces')
-            for interface, i_info  in  interfaces.iteritems():
-                for address in i_info.get('addresses', {}):
-                    addrs.append(address)
-        return addrs
+        return node_addresses(node_info)
 
     def add_to_run_list(self, hosts, recipe_list):
         for node_ip in hosts:
@@ -146,8 +367,8 @@ class ChefManager():
                 node_name = self.get_node_name_by_ip(node_ip)
             except FailedToFindNodeException:
                 print yellow("Doing initial bootstrap of " + node_ip)
-                execute(self.push_deployment_data, hosts=hosts)
-                execute(self.run_chef_client, hosts=hosts)
+                self.execute(self.push_deployment_data, hosts=hosts)
+                self.execute(self.run_chef_client, hosts=hosts)
                 node_name = self.get_node_name_by_ip(node_ip)
             for recipe in recipe_list:
                 if 'run_list' not in self.node_hash[node_name]:
@@ -176,20 +397,106 @@ class ChefManager():
                 'sudo bash -s -- -v ' + self.CHEF_VERSION)
 
     def run_chef_client(self, chef_command="chef-client -z"):
+        started = time.time()
         with cd(self.remote_folder_path + 'chef-repo'):
             with hide('running'):
-                return run(chef_command + " -E " + self.environment_name + " -l info")
+                result = run(chef_command + " -E " + self.environment_name + " -l info")
+        # Carried back to the parent process along with the result
+        result.started = started
+        result.duration = time.time() - started
+        return result
 
-    def push_deployment_data(self):
+    def push_deployment_data(self, cookbook_excludes=None,
+                             transfer_options=None):
+        # cookbook_excludes is {host: [cookbook, ...]} of the cookbooks a
+        # host does not need, they are left out and removed from the host.
+        # transfer_options is {host: {'compress_level': 0-9,
+        # 'bwlimit': KiB/s}} from TransferPolicy.options
+        cookbooks = os.path.relpath(self.workspace.cookbooks_dir,
+                                    self.workspace.root)
+        excluded = (cookbook_excludes or {}).get(env.host_string) or []
+        options = (transfer_options or {}).get(env.host_string) or {}
+        extra_opts = ['--stats']
+        if excluded:
+            extra_opts.append('--delete-excluded')
+        compress_level = options.get('compress_level', 6)
+        if compress_level:
+            extra_opts.append('--compress --compress-level={0}'.format(
+                compress_level))
+        if options.get('bwlimit'):
+            extra_opts.append('--bwlimit={0}'.format(options['bwlimit']))
+        started = time.time()
         with hide(*self.hidden_outputs):
             info("rsyncing deployment data...")
-            rsync_project(local_dir='./',
+            result = rsync_project(local_dir=self.workspace.root + '/',
                     remote_dir=self.remote_folder_path,
-                    ssh_opts=self.ssh_opts, delete=True)
-
-    def pull_node_info(self):
-        local_path = 'chef-repo/nodes/' + run('hostname') + '.json'
-        remote_path = self.remote_folder_path + local_path
-        if self.local_hostname != run('hostname'):
-            get(remote_path=remote_path, local_path=local_path)
-            self.read_node_hash(local_path)
+                    exclude=['/{0}/{1}/'.format(cookbooks, name)
+                             for name in excluded],
+                    default_opts='-pthr', extra_opts=' '.join(extra_opts),
+                    ssh_opts=self.ssh_opts, delete=True, capture=True)
+        # Carried back to the parent process along with the result
+        result.started = started
+        result.duration = time.time() - started
+        result.bytes_sent, result.file_bytes = transfer_stats(result)
+        result.compress_level = compress_level
+        result.bwlimit = options.get('bwlimit')
+        return result
+
+    @staticmethod
+    def file_digest(path):
+        if not os.path.isfile(path):
+            return ''
+        with open(path, 'rb') as handle:
+            return hashlib.md5(handle.read()).hexdigest()
+
+    def read_node_file(self, known_digests):
+        # Task that prints the host's name, then the md5 of its node file
+        # and, unless that matches the copy we have, the gzipped file
+        command = ('h=$(hostname); f={0}chef-repo/nodes/$h.json; echo $h; '
+                   '[ -f $f ] || exit 0; s=$(md5sum < $f | cut -c1-32); '
+                   'echo $s; [ "$s" = "{1}" ] || gzip -c $f | base64'
+                   .format(self.remote_folder_path,
+                           known_digests.get(env.host_string, '')))
+        with hide(*self.hidden_outputs):
+            return run(command, pty=False)
+
+    def pull_node_info(self, hosts):
+        """
+        Fetch the node files that changed on hosts in one parallel round-trip
+        each, then parse them in a pool of processes, since decoding and
+        parsing them is CPU-bound, and update node_hash in one step
+        """
+        known_digests = {}
+        for host in hosts:
+            hostname = self.remote_hostnames.get(host)
+            if hostname:
+                known_digests[host] = self.file_digest(
+                    self.chef_repo_dir + 'nodes/' + hostname + '.json')
+        with hide(*self.hidden_outputs):
+            outputs = self.execute(self.read_node_file, known_digests,
+                                   hosts=hosts)
+        known_nodes = set(self.node_hash)
+        results = {}
+        pool = multiprocessing.Pool(min(len(outputs), cpu_count()) or 1)
+        try:
+            pending = dict((host, pool.apply_async(
+                store_node_file, (str(output), self.local_hostname,
+                                  self.chef_repo_dir, known_nodes)))
+                for host, output in outputs.iteritems())
+            for host, result in pending.iteritems():
+                try:
+                    results[host] = result.get()
+                except Exception as e:
+                    results[host] = e
+        finally:
+            pool.close()
+            pool.join()
+        node_hash = {}
+        for host, result in results.iteritems():
+            if isinstance(result, Exception):
+                error('Unable to read node info from ' + host + ': ' +
+                      str(result))
+            if result:
+                self.remote_hostnames[host] = result[0]
+                node_hash[result[0]] = result[1]
+        self.node_hash.update(node_hash)
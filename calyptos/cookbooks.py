@@ -0,0 +1,67 @@
+import json
+import os
+import re
+
+DEPENDS = re.compile(r'''^\s*depends\s+['"]([^'"]+)['"]''', re.MULTILINE)
+
+
+def recipe_cookbook(recipe):
+    # 'recipe[ceph::mon]', 'ceph::mon' and 'ceph' all belong to ceph
+    if recipe.startswith('role['):
+        return None
+    if recipe.startswith('recipe[') and recipe.endswith(']'):
+        recipe = recipe[len('recipe['):-1]
+    return recipe.split('::')[0]
+
+
+def read_dependencies(cookbook_dir):
+    """
+    Return the names of the cookbooks a vendored cookbook depends on, from
+    its metadata.json or else its metadata.rb
+    """
+    metadata_json = os.path.join(cookbook_dir, 'metadata.json')
+    if os.path.isfile(metadata_json):
+        with open(metadata_json) as metadata:
+            try:
+                return set((json.load(metadata).get('dependencies') or {}))
+            except ValueError:
+                pass
+    metadata_rb = os.path.join(cookbook_dir, 'metadata.rb')
+    if os.path.isfile(metadata_rb):
+        with open(metadata_rb) as metadata:
+            return set(DEPENDS.findall(metadata.read()))
+    return set()
+
+
+class CookbookIndex(object):
+    """
+    Dependencies between the cookbooks vendored into a chef-repo, to work out
+    which cookbooks a run list needs
+    """
+
+    def __init__(self, cookbooks_dir):
+        self.dependencies = {}
+        if os.path.isdir(cookbooks_dir):
+            for name in sorted(os.listdir(cookbooks_dir)):
+                path = os.path.join(cookbooks_dir, name)
+                if os.path.isdir(path):
+                    self.dependencies[name] = read_dependencies(path)
+
+    @property
+    def names(self):
+        return set(self.dependencies)
+
+    def closure(self, run_list):
+        # Every vendored cookbook the recipes need, directly or not
+        needed = set()
+        pending = [recipe_cookbook(recipe) for recipe in run_list]
+        while pending:
+            name = pending.pop()
+            if name in needed or name not in self.dependencies:
+                continue
+            needed.add(name)
+            pending.extend(self.dependencies[name])
+        return needed
+
+    def excluded(self, run_list):
+        return sorted(self.names - self.closure(run_list))
@@ -0,0 +1,30 @@
+import hashlib
+import os
+
+
+def content_hash(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+def file_hash(path):
+    # The content_hash of the file at path, or None if there is no file
+    try:
+        with open(path, 'rb') as handle:
+            return content_hash(handle.read())
+    except IOError:
+        return None
+
+
+def write_if_changed(path, content):
+    """
+    Atomically replace path with content unless it already holds exactly
+    that content, so that unchanged files keep their mtime. Returns the
+    content hash and whether the file was written.
+    """
+    digest = content_hash(content)
+    if file_hash(path) == digest:
+        return digest, False
+    with open(path + '.part', 'wb') as handle:
+        handle.write(content)
+    os.rename(path + '.part', path)
+    return digest, True
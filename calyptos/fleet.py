@@ -0,0 +1,121 @@
+from collections import Counter
+from fabric.context_managers import hide, settings
+from fabric.decorators import parallel
+from fabric.exceptions import CommandTimeout, NetworkError
+from fabric.operations import run
+from fabric.state import env
+from calyptos.parallel import FABRIC_LOCK, fabric_execute
+import hashlib
+import multiprocessing
+import threading
+import time
+
+
+@parallel
+def command_task(command, timeout=None, user='root', results=None):
+    # Task to run command on host and report what happened, never aborting.
+    # The result goes on the results queue as soon as it is known and only
+    # its status is returned, so outputs are not also collected by Fabric.
+    env.user = user
+    start = time.time()
+    result = {'status': 'ok', 'exit_code': None, 'output': ''}
+    try:
+        with settings(hide('everything', 'aborts'), warn_only=True):
+            output = run(command, timeout=timeout)
+        result['exit_code'] = output.return_code
+        result['output'] = str(output)
+        if output.failed:
+            result['status'] = 'failed'
+    except CommandTimeout:
+        result['status'] = 'timeout'
+    except (NetworkError, SystemExit) as e:
+        result['status'] = 'unreachable'
+        result['output'] = str(e)
+    result['duration'] = time.time() - start
+    if results is None:
+        return result
+    results.put((env.host_string, result))
+    return result['status']
+
+
+def stream_command(command, hosts, concurrency=50, timeout=None, user='root',
+                   password=None):
+    """
+    Run command on hosts, at most concurrency at a time, and yield
+    (host, result) as each host finishes. Fabric's pool starts the next
+    host as soon as one is done, so a slow host only holds its own slot.
+    """
+    hosts = sorted(hosts)
+    results = multiprocessing.Queue()
+    pending = set(hosts)
+    # Why a host never reported, None for the whole execute
+    errors = {}
+
+    def run_all():
+        # The only Fabric execute, its pool gives the concurrency
+        try:
+            with FABRIC_LOCK, settings(
+                    hide('running'), password=password,
+                    timeout=timeout or env.timeout, pool_size=concurrency,
+                    connection_attempts=1, skip_bad_hosts=True):
+                statuses = fabric_execute(
+                    command_task, command=command, timeout=timeout,
+                    user=user, results=results, hosts=hosts)
+            errors.update((host, status)
+                          for host, status in statuses.iteritems()
+                          if isinstance(status, BaseException))
+        except BaseException as e:
+            errors[None] = e
+        finally:
+            results.put(None)
+
+    runner = threading.Thread(target=run_all)
+    runner.daemon = True
+    runner.start()
+    for host, result in iter(results.get, None):
+        pending.discard(host)
+        yield host, result
+    runner.join()
+    # Hosts whose process died before reporting
+    for host in sorted(pending):
+        error = errors.get(host, errors.get(None))
+        yield host, {'status': 'unreachable', 'exit_code': None,
+                     'output': str(error or ''), 'duration': 0}
+
+
+def result_label(result):
+    # The exit code, or why there is none
+    if result['status'] in ('timeout', 'unreachable'):
+        return result['status']
+    return 'exit ' + str(result['exit_code'])
+
+
+class OutputGroups(object):
+    """
+    Hosts grouped by identical result and output. Only the first copy of
+    each distinct output is kept.
+    """
+
+    def __init__(self):
+        self.groups = {}
+        self.histogram = Counter()
+
+    def add(self, host, result):
+        output = result['output']
+        if isinstance(output, unicode):
+            output = output.encode('utf-8')
+        label = result_label(result)
+        key = (label, hashlib.sha1(output).hexdigest())
+        if key not in self.groups:
+            self.groups[key] = {'label': label, 'output': output,
+                                'hosts': []}
+        self.groups[key]['hosts'].append(host)
+        self.histogram[label] += 1
+
+    def largest_first(self):
+        return sorted(self.groups.itervalues(),
+                      key=lambda group: (-len(group['hosts']), group['label']))
+
+    def failed(self):
+        return sum(count for label, count in self.histogram.iteritems()
+                   if label != 'exit 0')
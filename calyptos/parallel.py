@@ -0,0 +1,126 @@
+from contextlib import contextmanager
+import multiprocessing
+from Queue import Queue, Empty
+import threading
+
+# Fabric keeps its settings in one global env that execute() changes while
+# it runs, and parallel tasks fork. Only one thread at a time may execute.
+FABRIC_LOCK = threading.RLock()
+
+
+def fabric_execute(task, *args, **kwargs):
+    """
+    Fabric's execute() for code that runs in threads. Concurrency comes
+    from the parallel task's own process pool, not from the threads.
+    """
+    from fabric.tasks import execute
+    with FABRIC_LOCK:
+        return execute(task, *args, **kwargs)
+
+
+class HostLimiter(object):
+    """
+    Caps how many hosts are being worked on at once across every thread
+    that shares this limiter.
+    """
+
+    def __init__(self, max_hosts=20):
+        self.max_hosts = max(1, int(max_hosts))
+        self._available = self.max_hosts
+        self._condition = threading.Condition()
+
+    def acquire(self, count):
+        count = max(1, min(count, self.max_hosts))
+        with self._condition:
+            while self._available < count:
+                self._condition.wait()
+            self._available -= count
+        return count
+
+    def release(self, count):
+        with self._condition:
+            self._available += count
+            self._condition.notify_all()
+
+    @contextmanager
+    def slots(self, count):
+        acquired = self.acquire(count)
+        try:
+            yield acquired
+        finally:
+            self.release(acquired)
+
+    def batches(self, hosts):
+        """
+        Split hosts into lists no bigger than the limit so that each batch
+        can hold its slots for the duration of a single execute()
+        """
+        hosts = list(hosts)
+        for index in range(0, len(hosts), self.max_hosts):
+            yield hosts[index:index + self.max_hosts]
+
+
+class ProcessGroupLimiter(object):
+    """
+    Caps how many members of each group are being worked on at once across
+    the processes Fabric forks for a parallel task. A host only starts once
+    every group it belongs to has a free slot. It must be created before
+    execute() so that every process shares it.
+    """
+
+    def __init__(self, limits):
+        self.semaphores = dict((group, multiprocessing.Semaphore(
+            max(1, int(limit)))) for group, limit in limits.iteritems())
+
+    @contextmanager
+    def slots(self, groups):
+        # Taken in sorted order so that two hosts never wait on each other
+        groups = sorted(set(group for group in groups
+                            if group in self.semaphores))
+        acquired = []
+        try:
+            for group in groups:
+                self.semaphores[group].acquire()
+                acquired.append(group)
+            yield
+        finally:
+            for group in reversed(acquired):
+                self.semaphores[group].release()
+
+
+def map_concurrently(func, items, max_workers=10):
+    """
+    Call func on every item using at most max_workers threads and return a
+    dict of item -> result. An exception raised by func is returned as that
+    item's result rather than propagated.
+    """
+    items = list(items)
+    results = {}
+    if not items:
+        return results
+    work = Queue()
+    for item in items:
+        work.put(item)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                item = work.get_nowait()
+            except Empty:
+                return
+            try:
+                result = func(item)
+            except Exception as e:
+                result = e
+            with lock:
+                results[item] = result
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, min(max_workers, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
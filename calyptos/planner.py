@@ -0,0 +1,112 @@
+import heapq
+
+
+class Stage(object):
+    """
+    One round of chef runs: the run list changes made first, then the hosts
+    chef-client is run on
+    """
+
+    def __init__(self, name, hosts, additions, clear=False):
+        self.name = name
+        self.hosts = sorted(hosts)
+        # (hosts, recipes) in the order they are added to run lists
+        self.additions = additions
+        # Whether every run list is emptied before the additions
+        self.clear = clear
+
+
+def run_lists(stages, all_hosts):
+    """
+    Replay the run list changes of each stage without touching any host and
+    return [(stage, {host: run_list})] for the hosts each stage runs on
+    """
+    current = dict((host, []) for host in all_hosts)
+    planned = []
+    for stage in stages:
+        if stage.clear:
+            for host in current:
+                current[host] = []
+        for hosts, recipes in stage.additions:
+            for host in hosts:
+                run_list = current.setdefault(host, [])
+                for recipe in recipes:
+                    if recipe not in run_list:
+                        run_list.append(recipe)
+        planned.append((stage, dict((host, list(current.get(host, [])))
+                                    for host in stage.hosts)))
+    return planned
+
+
+class Estimator(object):
+    """
+    Estimates how long chef runs take, in seconds, from recorded timings of
+    the same host and run list, else from per-recipe weights. The recipes
+    of a role with a weight of its own are counted as that weight instead.
+    """
+
+    def __init__(self, recipe_seconds=None, default_recipe_seconds=60,
+                 run_overhead_seconds=30, pool_size=20, recorded=None,
+                 role_seconds=None, host_roles=None, role_recipes=None):
+        # {(host, (recipe, ...)): seconds} from TimingDatabase.host_seconds
+        self.recorded = recorded or {}
+        self.role_seconds = role_seconds or {}
+        # {host: roles} and {role: recipes}, needed for role_seconds
+        self.host_roles = host_roles or {}
+        self.role_recipes = role_recipes or {}
+        self.recipe_seconds = recipe_seconds or {}
+        self.default_recipe_seconds = default_recipe_seconds
+        self.run_overhead_seconds = run_overhead_seconds
+        self.pool_size = max(1, pool_size)
+
+    def host_seconds(self, host, run_list):
+        recorded = self.recorded.get((host, tuple(run_list)))
+        if recorded is not None:
+            return recorded
+        seconds = self.run_overhead_seconds
+        remaining = list(run_list)
+        for role in sorted(self.host_roles.get(host, ())):
+            if role not in self.role_seconds:
+                continue
+            recipes = self.role_recipes.get(role, ())
+            if any(recipe in recipes for recipe in remaining):
+                seconds += self.role_seconds[role]
+                remaining = [recipe for recipe in remaining
+                             if recipe not in recipes]
+        return seconds + sum(
+            self.recipe_seconds.get(recipe, self.default_recipe_seconds)
+            for recipe in remaining)
+
+    def longest_first(self, host_run_lists):
+        """
+        Order hosts so that Fabric starts the longest chef runs first. Its
+        job queue takes hosts from the end of the list, so they are sorted
+        shortest first.
+        """
+        return sorted(host_run_lists, key=lambda host: (
+            self.host_seconds(host, host_run_lists[host]), host))
+
+    def waves(self, hosts):
+        # Hosts in groups of at most pool_size, in the order Fabric starts
+        # them: its job queue takes hosts from the end of the list
+        started = list(reversed(hosts))
+        return [started[i:i + self.pool_size]
+                for i in range(0, len(started), self.pool_size)]
+
+    def stage_seconds(self, host_run_lists, hosts=None):
+        # Replay Fabric's pool: each host starts as soon as a slot is free
+        hosts = hosts if hosts is not None else sorted(host_run_lists)
+        slots = [0] * min(self.pool_size, len(hosts) or 1)
+        for host in reversed(hosts):
+            start = heapq.heappop(slots)
+            heapq.heappush(slots, start + self.host_seconds(
+                host, host_run_lists[host]))
+        return max(slots)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{0}h{1:02d}m'.format(hours, minutes)
+    return '{0}m{1:02d}s'.format(minutes, seconds)
@@ -1,52 +1,54 @@
-from fabric.context_managers import hide
-import re
 from calyptos.plugins.debugger.debuggerplugin import DebuggerPlugin
 
 
 class CheckPorts(DebuggerPlugin):
+    # Used when the config file has no debugger: check_ports: section
+    DEFAULT_PORTS = {'clc': {'tcp': [8773, 8777, 8443, 8779],
+                             'udp': [7500, 8778]},
+                     'user-facing': {'tcp': [8773, 53],
+                                     'udp': [53]},
+                     'cluster-controller': {'tcp': [8774],
+                                            'udp': []},
+                     'storage-controller': {'tcp': [8773],
+                                            'udp': []},
+                     'node-controller': {'tcp': [8775],
+                                         'udp': []}}
+
     def debug(self):
         all_hosts = self.component_deployer.all_hosts
-        with hide('everything'):
-            ports = self.run_command_on_hosts('netstat -lnp', all_hosts)
-        roles = self.component_deployer.get_roles()
-        clc_ports = {'tcp': [8773, 8777, 8443, 8779],
-                     'udp': [7500, 8778]}
-        ufs_ports = {'tcp': [8773, 53],
-                     'udp': [53]}
-        cc_ports = {'tcp': [8774],
-                    'udp': []}
-        sc_ports = {'tcp': [8773],
-                    'udp': []}
-        nc_ports = {'tcp': [8775],
-                    'udp': []}
-
-        def check_port_map(port_map):
-            for proto, ports in port_map.iteritems():
-                for port in ports:
-                    if not self._check_port(netstat, proto, port, host):
-                        closed_ports.append(port)
-        for host, netstat in ports.iteritems():
-            closed_ports = []
-            if host in roles['clc']:
-                check_port_map(clc_ports)
-            if host in roles['user-facing']:
-                check_port_map(ufs_ports)
-            if host in roles['cluster-controller']:
-                check_port_map(cc_ports)
-            if host in roles['storage-controller']:
-                check_port_map(sc_ports)
-            if host in roles['node-controller']:
-                check_port_map(nc_ports)
-            if closed_ports:
-                raise AssertionError('Required ports '
-                                     'not open on host ' + host + '\n' +
-                                     str(closed_ports))
+        host_facts = self.facts.gather(all_hosts)
+        required_ports = self._required_ports()
+        closed_ports = {}
+        for host in sorted(required_ports):
+            open_ports = self._socket_table(host_facts[host]['sockets'])
+            for proto, port in sorted(required_ports[host]):
+                if not self._check_port(open_ports, proto, port, host):
+                    closed_ports.setdefault(host, []).append(
+                        proto + '/' + str(port))
+        for host, ports in sorted(closed_ports.iteritems()):
+            self.info(host + ': Required ports not open ' + ', '.join(ports))
         return self.passed, self.failed
 
-    def _check_port(self, netstat, proto, port, host):
-        port_string = proto + '.*:' + str(port)
-        search = re.search(port_string, netstat)
-        if search:
+    def _required_ports(self):
+        # Map each host to the set of (proto, port) its roles require
+        port_config = self.config.get('check_ports') or self.DEFAULT_PORTS
+        required = {}
+        for role, port_map in port_config.iteritems():
+            for host in self.roles.get(role, []):
+                for proto, ports in port_map.iteritems():
+                    for port in ports or []:
+                        required.setdefault(host, set()).add((proto,
+                                                              int(port)))
+        return required
+
+    @staticmethod
+    def _socket_table(sockets):
+        return set((proto, port) for proto, address, port, process
+                   in sockets)
+
+    def _check_port(self, open_ports, proto, port, host):
+        port_string = proto + '/' + str(port)
+        if (proto, port) in open_ports:
             self.success(host + ': Open ' + port_string)
             return True
         else:
@@ -1,9 +1,45 @@
 from fabric.context_managers import hide, show
 import re
 from calyptos.plugins.debugger.debuggerplugin import DebuggerPlugin
+from calyptos.plugins.debugger.facts import HostFacts
 
 
 class DebugCloudController(DebuggerPlugin):
+    # Run on every CLC as part of the shared host facts, so that checking
+    # them needs no SSH of its own
+    COMMANDS = {'describe-services': 'euca-describe-services',
+                'psql-tables': 'echo "\\pset pager false;\\dt *.*;" | psql '
+                               '-h /var/lib/eucalyptus/db/data/ -p 8777 '
+                               'eucalyptus_shared',
+                'db-size': 'du -s /var/lib/eucalyptus/db/'}
+
+    def __init__(self, component_deployer, collector=None, host_limiter=None,
+                 facts=None, config=None):
+        if facts is None:
+            # Run on its own, gather the CLC commands with the other facts
+            facts = HostFacts(commands=self.fact_commands(component_deployer),
+                              host_limiter=host_limiter)
+        DebuggerPlugin.__init__(self, component_deployer, collector,
+                                host_limiter, facts, config)
+
+    @classmethod
+    def fact_commands(cls, component_deployer):
+        """
+        Return the {host: {name: command}} to gather with the host facts
+        """
+        return dict((clc, dict(cls.COMMANDS))
+                    for clc in component_deployer.roles['clc'])
+
+    def _command_output(self, clc, name):
+        # Output of one of the CLC's commands, None if it was not gathered,
+        # e.g. with facts loaded from an older file
+        result = self.facts.command(clc, name)
+        if result is None:
+            self.failure(clc + ': ' + self.COMMANDS[name] +
+                         ' output was not gathered')
+            return None
+        return result['output']
+
     def debug(self):
         #clcs = self.role_builder.roles['clc']
         clcs = self.component_deployer.roles['clc'] 
@@ -18,16 +54,16 @@ class DebugCloudController(DebuggerPlugin):
         return (self.passed, self.failed)
 
     def _check_service_running(self, clc):
-        clc_service_state = self.run_command_on_host(
-            'service eucalyptus-cloud status', host=clc)
-        if re.search('running', clc_service_state):
+        clc_service_state = self.facts.get(clc)['services']['eucalyptus-cloud']
+        if clc_service_state['running']:
             self.success(clc + ': CLC service running')
         else:
             self.failure(clc + ': CLC service not running')
 
     def _services_enabled(self, clc):
-        describe_services = self.run_command_on_host('euca-describe-services',
-                                                     host=clc)
+        describe_services = self._command_output(clc, 'describe-services')
+        if describe_services is None:
+            return
         for state in ['DISABLED', 'BROKEN', 'NOTREADY']:
             search = re.search('.*' + state + '.*', describe_services)
             if search:
@@ -37,8 +73,9 @@ class DebugCloudController(DebuggerPlugin):
                 self.success(clc + ': No services in ' + state)
 
     def _psql_available(self, clc):
-        psql_dt = 'echo "\pset pager false;\dt *.*;" | psql -h /var/lib/eucalyptus/db/data/ -p 8777 eucalyptus_shared'
-        psql_dt_out = self.run_command_on_host(psql_dt, host=clc)
+        psql_dt_out = self._command_output(clc, 'psql-tables')
+        if psql_dt_out is None:
+            return
         if re.search('eucalyptus_cloud', psql_dt_out):
             self.success(clc + ': Was able to access postgres DB')
         else:
@@ -46,9 +83,15 @@ class DebugCloudController(DebuggerPlugin):
             print psql_dt_out
 
     def _db_size_check(self, clc):
-        db_size = 'du -s /var/lib/eucalyptus/db/'
-        db_size_out = self.run_command_on_host(db_size, host=clc)
-        db_size_mb = int(db_size_out.split()[0]) / 1024
+        db_size_out = self._command_output(clc, 'db-size')
+        if db_size_out is None:
+            return
+        try:
+            db_size_mb = int(db_size_out.split()[0]) / 1024
+        except (IndexError, ValueError):
+            self.failure(clc + ': Unable to find the database size')
+            print db_size_out
+            return
         if db_size_mb > 3000:
             self.failure(clc + ': Database is larger than 3GB. '
                                'Consider removing reporting '
@@ -57,11 +100,11 @@ class DebugCloudController(DebuggerPlugin):
             self.success(clc + ': DB size smaller than 3GB  ')
 
     def _var_lib_euca_size_check(self, clc):
-        df_vle = 'df -h --sync /var/lib/eucalyptus/ -P | ' \
-                 'awk \'{print $5}\' | grep -v Use'
-        vle_size = self.run_command_on_host(df_vle, host=clc)
-        vle_usage = int(vle_size.strip('%'))
-        if vle_usage > 85:
+        vle_usage = self.facts.disk_usage(clc, '/var/lib/eucalyptus')
+        if vle_usage is None:
+            self.failure(clc + ': Unable to find filesystem for '
+                               '/var/lib/eucalyptus')
+        elif vle_usage['used_percent'] > 85:
             self.failure(clc + ': /var/lib/eucalyptus is more that 85% full. '
                                'Consider deleting some files from '
                                'that filesystem')
@@ -69,8 +112,7 @@ class DebugCloudController(DebuggerPlugin):
             self.success(clc + ': /var/lib/eucalyptus is less than 85% full  ')
 
     def _memory_usage(self, clc):
-        free_mem = 'free | grep buffers | grep -v free | awk \'{print $3}\''
-        free_mem_size = int(self.run_command_on_host(free_mem, host=clc))
+        free_mem_size = self.facts.get(clc)['memory'].get('available', 0)
         if free_mem_size < 2000000:
             self.failure(clc + ': Less than 2GB of memory available. '
                                'Consider stop other process on this host')
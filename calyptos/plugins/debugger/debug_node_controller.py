@@ -1,21 +1,18 @@
-from fabric.context_managers import hide
-import re
 from calyptos.plugins.debugger.debuggerplugin import DebuggerPlugin
 
 class DebugNodeController(DebuggerPlugin):
     def debug(self):
         nodes = self.component_deployer.roles['node-controller']
         # Collect information
-        with hide('everything'):
-            nc_service_state = self.run_command_on_hosts('service eucalyptus-nc status', hosts=nodes)
-            libvirt_service_state = self.run_command_on_hosts('service libvirtd status', hosts=nodes)
+        node_facts = self.facts.gather(nodes)
 
         for node in nodes:
-            if re.search('running', nc_service_state[node]):
+            services = node_facts[node]['services']
+            if services['eucalyptus-nc']['running']:
                 self.success(node + ': NC service running')
             else:
                 self.failure(node + ': NC service not running')
-            if re.search('running', libvirt_service_state[node]):
+            if services['libvirtd']['running']:
                 self.success(node + ': libvirt service running')
             else:
                 self.failure(node + ': libvirt service not running')
@@ -2,22 +2,32 @@
 import abc
 import fabric
 from fabric.colors import red, green, cyan, yellow, white
-from fabric.decorators import task
+from fabric.decorators import task, parallel
 from fabric.operations import run, get, settings
 from fabric.state import env
-from fabric.tasks import execute
 from fabric.network import disconnect_all
 import six
+from calyptos.parallel import HostLimiter, fabric_execute
+from calyptos.plugins.debugger.facts import HostFacts
+from calyptos.results import ResultCollector
 
 
 @six.add_metaclass(abc.ABCMeta)
 class DebuggerPlugin(object):
     #Base class for example plugin used in the tutorial.
-
-    def __init__(self, component_deployer):
-        self.passed = 0
-        self.failed = 0
-        self.warnings = 0
+    # Plugins that keep Fabric busy for a long time run after the others
+    # rather than alongside them
+    runs_alone = False
+
+    def __init__(self, component_deployer, collector=None, host_limiter=None,
+                 facts=None, config=None):
+        # The collector, host limiter and host facts are shared between
+        # plugins when they are run concurrently by the debug command
+        self.collector = collector or ResultCollector()
+        self.host_limiter = host_limiter or HostLimiter()
+        self.facts = facts or HostFacts(host_limiter=self.host_limiter)
+        # The debugger section of the calyptos config file
+        self.config = config or {}
         self.message_style = "[{0: <20}] {1}"
         self.name = self.__class__.__name__
         self.component_deployer = component_deployer
@@ -34,23 +44,47 @@ class DebuggerPlugin(object):
         finally:
             self.report()
 
-    def success(self, message):
+    @property
+    def passed(self):
+        return self.collector.count(self.name, 'passed')
+
+    @property
+    def failed(self):
+        return self.collector.count(self.name, 'failed')
+
+    @property
+    def warnings(self):
+        return self.collector.count(self.name, 'warnings')
+
+    def _record(self, status, message, host=None, check=None, duration=None):
+        # Debugger messages are prefixed with the host they are about, use
+        # that prefix unless the host is given
+        if host is None:
+            prefix, separator, rest = message.partition(':')
+            if separator and (prefix == 'localhost' or
+                              prefix in self.component_deployer.all_hosts):
+                host = prefix
+                check = check or rest.strip()
+        self.collector.record(self.name, status, message, host=host,
+                              check=check, duration=duration)
+
+    def success(self, message, host=None, check=None, duration=None):
         # Function to display and tally success of a debug step
-        self.passed +=1
+        self._record('passed', message, host, check, duration)
         print green(self.message_style.format('DEBUG PASSED', message))
 
-    def failure(self, message):
+    def failure(self, message, host=None, check=None, duration=None):
         # Function to display and tally a failure of a debug step
-        self.failed +=1
+        self._record('failed', message, host, check, duration)
         print red(self.message_style.format('DEBUG FAILED', message))
 
     def info(self, message):
         # Function to display information of a debug step
         print white(self.message_style.format('INFO', message))
 
-    def warning(self, message):
+    def warning(self, message, host=None, check=None, duration=None):
         # Function to display and tally a warning of a debug step
-        self.warnings +=1
+        self._record('warnings', message, host, check, duration)
         print yellow(self.message_style.format('DEBUG WARNING', message))
 
     def report(self):
@@ -66,6 +100,7 @@ class DebuggerPlugin(object):
                                               str(self.failed))))
 
     @task
+    @parallel
     def run_command_task(command, user='root', password='foobar'):
         # Task to run command on host and return result
         env.user = user
@@ -74,6 +109,7 @@ class DebuggerPlugin(object):
         return run(command)
 
     @task
+    @parallel
     def get_file_task(remote_path, local_path, user='root', password='foobar'):
         # Task to grab file from host and return result
         env.user = user
@@ -84,16 +120,29 @@ class DebuggerPlugin(object):
 
     def get_file_on_host(self, remote_path, local_path, host):
         # Function to execute get_file_task on host
-        return execute(self.get_file_task, remote_path=remote_path,
-                       local_path=local_path, host=host)[host]
+        with self.host_limiter.slots(1):
+            return fabric_execute(self.get_file_task, remote_path=remote_path,
+                                  local_path=local_path, host=host)[host]
+
+    def execute_on_hosts(self, task, hosts, **kwargs):
+        # Function to execute a task on list of hosts, never holding more
+        # hosts than the shared limiter allows
+        results = {}
+        for batch in self.host_limiter.batches(hosts):
+            with self.host_limiter.slots(len(batch)):
+                results.update(fabric_execute(task, hosts=batch, **kwargs))
+        return results
 
     def run_command_on_hosts(self, command, hosts, host=None):
         # Function to execute run_command_task on list of hosts
-        return execute(self.run_command_task, command=command, hosts=hosts)
+        return self.execute_on_hosts(self.run_command_task, hosts,
+                                     command=command)
 
     def run_command_on_host(self, command, host):
         # Function to execute run_command_task on host
-        return execute(self.run_command_task, command=command, host=host)[host]
+        with self.host_limiter.slots(1):
+            return fabric_execute(self.run_command_task, command=command,
+                                  host=host)[host]
 
     def debug(self):
         """Format the data and return unicode text.
@@ -1,17 +1,109 @@
 import fabric
 from fabric.colors import white
-from fabric.decorators import task
+from fabric.decorators import task, parallel
 from fabric.operations import run, local
-from fabric.state import env
-from fabric.tasks import execute
+from fabric.state import env, connections
 from fabric.context_managers import hide
+import hashlib
+import json
+import os
 import re
+import socket
+import tarfile
 from datetime import datetime
+from calyptos.parallel import ProcessGroupLimiter
 from calyptos.plugins.debugger.debuggerplugin import DebuggerPlugin
 
+CHUNK_SIZE = 1024 * 1024
+
+
+def md5_file(filename):
+    checksum = hashlib.md5()
+    with open(filename, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(CHUNK_SIZE), ''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+@parallel
+def inspect_sosreport(remote_files, user='root'):
+    """
+    Return the size and md5sum of this host's sosreport
+    """
+    env.user = user
+    remote_path = remote_files[env.host]
+    output = run('stat -c %s {0} && md5sum {0}'.format(remote_path),
+                 warn_only=True)
+    if output.failed:
+        return None
+    size, md5 = output.split()[:2]
+    return {'size': int(size), 'md5': md5}
+
+
+def download_sosreport(remote_files, local_files, sizes, checksums,
+                       retries=3, user='root'):
+    """
+    Download this host's sosreport over SFTP into a .part file, resuming
+    from whatever is already on disk, and only move it into place once its
+    md5sum matches the one taken on the host
+    """
+    env.user = user
+    remote_path = remote_files[env.host]
+    local_path = local_files[env.host]
+    partial_path = local_path + '.part'
+    if os.path.exists(local_path) and md5_file(local_path) == checksums[env.host]:
+        return {'verified': True, 'resumed_from': sizes[env.host]}
+    resumed_from = 0
+    for attempt in range(retries):
+        offset = 0
+        if os.path.exists(partial_path):
+            offset = os.path.getsize(partial_path)
+        if offset > sizes[env.host]:
+            os.remove(partial_path)
+            offset = 0
+        if attempt == 0:
+            resumed_from = offset
+        try:
+            if attempt:
+                # The previous transfer broke, start from a fresh connection
+                connections.connect(env.host_string)
+            sftp = connections[env.host_string].open_sftp()
+            try:
+                remote_file = sftp.open(remote_path, 'rb')
+                remote_file.seek(offset)
+                with open(partial_path, 'ab') as local_file:
+                    for chunk in iter(lambda: remote_file.read(CHUNK_SIZE), ''):
+                        local_file.write(chunk)
+                remote_file.close()
+            finally:
+                sftp.close()
+        except (IOError, EOFError, socket.error):
+            continue
+        if md5_file(partial_path) == checksums[env.host]:
+            os.rename(partial_path, local_path)
+            return {'verified': True, 'resumed_from': resumed_from}
+        # Corrupt rather than short, a resume would not fix it
+        os.remove(partial_path)
+    return {'verified': False, 'resumed_from': resumed_from}
 
 
 class EucalyptusSosReports(DebuggerPlugin):
+    # Generating sosreports can take up to the timeout
+    runs_alone = True
+    # Used when the config file has no debugger: sosreport: section
+    DEFAULT_OPTIONS = {'concurrency': 20,
+                       'per_cluster': None,
+                       'per_role': {},
+                       'timeout': 1800,
+                       'nice': None,
+                       'ionice_class': None,
+                       'only_plugins': [],
+                       'skip_plugins': [],
+                       'download_concurrency': 5,
+                       'download_retries': 3,
+                       'min_free_mb': 512,
+                       'archive': False}
+
     def debug(self):
         roles = self.component_deployer.get_roles()
 
@@ -91,10 +183,10 @@ class EucalyptusSosReports(DebuggerPlugin):
             Execute sosreport on all hosts
             """
             sosreport_output = self.execute_sosreports_on_hosts(hosts=all_hosts)
+        remote_files = {}
         for host in all_hosts:
             """
-            Confirm sosreport ran successfully;
-            Download sosreport to local client
+            Confirm sosreport ran successfully
             """
             hostname = host.replace(".", '')
             sosfile = 'sosreport-' + hostname
@@ -103,20 +195,119 @@ class EucalyptusSosReports(DebuggerPlugin):
                 if sosreport_file:
                     self.success(host + ':sosreport finished - '
                                 + output)
-                    remote_path = output.strip()
-                    local_file = remote_path.split('/')[2]
-                    format_host = host.replace(".", "_")
-                    local_path = directory + "/" + format_host + "-" + local_file
-                    with hide('everything'):
-                        cp_output = self.get_file_on_host(remote_path,
-                                                          local_path,
-                                                          host=host)
-                    if cp_output:
-                        self.success(host + ':sosreport downloaded - '
-                                    + local_path)
-                    else:
-                        self.failure(host + ':sosreport failed to download - '
-                                    + local_path)
+                    remote_files[host] = output.strip()
+            if host not in remote_files:
+                self.failure(host + ':sosreport did not finish')
+        self._download_sosreports(remote_files, directory)
+
+    def _sosreport_options(self):
+        options = dict(self.DEFAULT_OPTIONS)
+        options.update(self.config.get('sosreport') or {})
+        return options
+
+    def _download_sosreports(self, remote_files, directory):
+        """
+        Download sosreports from all hosts concurrently after checking
+        there is room for them locally
+        """
+        if not remote_files:
+            return
+        options = self._sosreport_options()
+        local_files = {}
+        for host, remote_path in remote_files.iteritems():
+            local_file = remote_path.split('/')[2]
+            format_host = host.replace(".", "_")
+            local_files[host] = directory + "/" + format_host + "-" + local_file
+        with hide('everything'):
+            inspected = self.execute_on_hosts(inspect_sosreport,
+                                              remote_files.keys(),
+                                              remote_files=remote_files)
+        sizes = {}
+        checksums = {}
+        for host, result in inspected.iteritems():
+            if isinstance(result, dict):
+                sizes[host] = result['size']
+                checksums[host] = result['md5']
+            else:
+                self.failure(host + ':sosreport could not be inspected - '
+                             + remote_files[host])
+        if not self._enough_disk_space(directory, local_files, sizes,
+                                       options['min_free_mb']):
+            return
+        download = parallel(pool_size=options['download_concurrency'])(
+            download_sosreport)
+        with hide('everything'):
+            downloaded = self.execute_on_hosts(
+                download, sizes.keys(), remote_files=remote_files,
+                local_files=local_files, sizes=sizes, checksums=checksums,
+                retries=options['download_retries'])
+        index = []
+        for host in sorted(downloaded):
+            result = downloaded[host]
+            local_path = local_files[host]
+            if isinstance(result, dict) and result['verified']:
+                message = host + ':sosreport downloaded - ' + local_path
+                if result['resumed_from']:
+                    message += ' (resumed at byte {0})'.format(
+                        result['resumed_from'])
+                self.success(message)
+                index.append({'host': host,
+                              'file': os.path.basename(local_path),
+                              'size': sizes[host],
+                              'md5': checksums[host]})
+            else:
+                self.failure(host + ':sosreport failed to download - '
+                             + local_path)
+        if options['archive'] and index:
+            self._archive_sosreports(directory, index)
+
+    def _enough_disk_space(self, directory, local_files, sizes, min_free_mb):
+        """
+        Make sure the local filesystem can take every sosreport that still
+        has to be downloaded and keep min_free_mb to spare
+        """
+        needed = 0
+        for host, size in sizes.iteritems():
+            partial_path = local_files[host] + '.part'
+            if os.path.exists(partial_path):
+                size -= os.path.getsize(partial_path)
+            needed += max(size, 0)
+        try:
+            stats = os.statvfs(directory)
+        except OSError as e:
+            # Most likely the directory could not be created
+            self.failure('localhost: Unable to check disk space in ' +
+                         directory + ' - ' + str(e))
+            return False
+        available = stats.f_bavail * stats.f_frsize
+        if needed + min_free_mb * 1024 * 1024 > available:
+            self.failure('localhost: Not enough disk space in ' + directory +
+                         ' for sosreports, need {0}MB with {1}MB '
+                         'available'.format(needed / 1024 / 1024,
+                                            available / 1024 / 1024))
+            return False
+        return True
+
+    def _archive_sosreports(self, directory, index):
+        """
+        Move the downloaded sosreports into a single tarball along with an
+        index of the host, size and md5sum of each one
+        """
+        archive_name = directory + '.tar'
+        index_name = os.path.join(directory, 'index.json')
+        with open(index_name, 'w') as index_file:
+            json.dump(index, index_file, indent=4, sort_keys=True)
+        archive = tarfile.open(archive_name, 'w')
+        try:
+            archive.add(index_name, arcname='index.json')
+            for entry in index:
+                local_path = os.path.join(directory, entry['file'])
+                archive.add(local_path, arcname=entry['file'])
+                os.remove(local_path)
+        finally:
+            archive.close()
+        os.remove(index_name)
+        self.success('localhost: sosreports archived - ' + archive_name)
 
     @task
     def create_localdir(directory):
@@ -127,11 +318,18 @@ class EucalyptusSosReports(DebuggerPlugin):
         return local("mkdir -v " + directory, capture=True)
 
     @task
-    def sosreport_command_task(user='root', password='foobar'):
+    @parallel
+    def sosreport_command_task(command_prefix='', extra_options='',
+                               user='root', password='foobar',
+                               group_limiter=None, host_groups=None):
         """
         Execute sosreport on each host, passing hostname
-        and ticket number
+        and ticket number, once the host's groups have a free slot
         """
+        if group_limiter is not None:
+            with group_limiter.slots((host_groups or {}).get(env.host, [])):
+                return EucalyptusSosReports.sosreport_command_task(
+                    command_prefix, extra_options, user, password)
         env.user = user
         env.password = password
         env.parallel = True
@@ -139,14 +337,66 @@ class EucalyptusSosReports(DebuggerPlugin):
         message = 'Running sosreport on ' + env.host
         message_style = "[{0: <20}] {1}"
         print white(message_style.format('INFO', message))
-        sosreport_command = ("sosreport --name=" + hostname
+        sosreport_command = (command_prefix + "sosreport --name=" + hostname
                             + " --ticket-number=000 "
-                            + "--batch")
-        return run(sosreport_command)
+                            + "--batch" + extra_options)
+        return run(sosreport_command, warn_only=True)
 
-    def execute_sosreports_on_hosts(self, hosts, host=None):
+    def _sosreport_command(self, options):
         """
-        Run sosreport_command_task on each host
+        Build the prefix and extra options that bound how long sosreport may
+        run, how hard it may hit the host and which plugins it collects
         """
-        return execute(self.sosreport_command_task, hosts=hosts)
+        prefix = ''
+        if options.get('timeout'):
+            prefix += 'timeout {0} '.format(int(options['timeout']))
+        if options.get('nice') is not None:
+            prefix += 'nice -n {0} '.format(int(options['nice']))
+        if options.get('ionice_class') is not None:
+            prefix += 'ionice -c {0} '.format(int(options['ionice_class']))
+        extra_options = ''
+        if options.get('only_plugins'):
+            extra_options += ' --only-plugins=' + ','.join(
+                options['only_plugins'])
+        if options.get('skip_plugins'):
+            extra_options += ' --skip-plugins=' + ','.join(
+                options['skip_plugins'])
+        return prefix, extra_options
+
+    def _host_groups(self, host):
+        groups = ['role:' + role for role, hosts in self.roles.iteritems()
+                  if role not in ('all', 'cluster') and host in hosts]
+        for cluster, hosts in self.roles.get('cluster', {}).iteritems():
+            if host in hosts:
+                groups.append('cluster:' + cluster)
+        return groups
+
+    def _group_limits(self, options):
+        limits = {}
+        if options.get('per_cluster'):
+            for cluster in self.roles.get('cluster', {}):
+                limits['cluster:' + cluster] = options['per_cluster']
+        for role, limit in (options.get('per_role') or {}).iteritems():
+            limits['role:' + role] = limit
+        return limits
 
+    def execute_sosreports_on_hosts(self, hosts, host=None):
+        """
+        Run sosreport_command_task on each host, rolling through them so
+        that no more than the configured number of hosts in any cluster or
+        role are generating a sosreport at the same time
+        """
+        options = self._sosreport_options()
+        command_prefix, extra_options = self._sosreport_command(options)
+        # One execute whose process pool rolls through the hosts, each
+        # process waiting for its cluster and role slots
+        group_limiter = ProcessGroupLimiter(self._group_limits(options))
+        host_groups = dict((host, self._host_groups(host)) for host in hosts)
+        sosreport_task = parallel(pool_size=options['concurrency'])(
+            self.sosreport_command_task)
+        results = self.execute_on_hosts(sosreport_task, hosts,
+                                        command_prefix=command_prefix,
+                                        extra_options=extra_options,
+                                        group_limiter=group_limiter,
+                                        host_groups=host_groups)
+        return dict((host, str(results.get(host) or '')) for host in hosts)
@@ -0,0 +1,214 @@
+import json
+import re
+import threading
+from fabric.context_managers import hide
+from fabric.decorators import task, parallel
+from fabric.operations import run
+from fabric.state import env
+from calyptos.parallel import HostLimiter, fabric_execute
+
+
+@task
+@parallel
+def gather_facts_task(scripts, user='root'):
+    # Task to run this host's combined fact gathering script
+    env.user = user
+    env.parallel = True
+    return run(scripts[env.host], warn_only=True)
+
+
+class HostFacts(object):
+    """
+    Snapshot of listening sockets, service states, disk and memory usage and
+    file ownership for each host, collected with a single remote command per
+    host and shared by every debugger plugin.
+    """
+    SERVICES = ['eucalyptus-cloud', 'eucalyptus-cc', 'eucalyptus-nc',
+                'libvirtd']
+    PATHS = ['/var/lib/eucalyptus', '/var/log/eucalyptus']
+    SECTION = '@@calyptos-fact '
+    SECTION_REGEX = re.compile(r'^@@calyptos-fact (\S+)(?: (\S+))?$')
+    RETURN_CODE_REGEX = re.compile(r'^@@calyptos-rc (\d+)$')
+
+    def __init__(self, services=None, paths=None, depth=0, host_limiter=None,
+                 recursive_paths=None, commands=None):
+        self.services = services or self.SERVICES
+        # {host: {name: command}} of extra commands whose output and return
+        # code are gathered from particular hosts
+        self.commands = commands or {}
+        # Ownership of everything below recursive_paths is reported
+        self.recursive_paths = sorted(set(recursive_paths or []))
+        self.paths = [path for path in paths or self.PATHS
+                      if path not in self.recursive_paths]
+        # How far below each of paths to report ownership, 0 is the path
+        self.depth = int(depth)
+        self.host_limiter = host_limiter or HostLimiter()
+        self.snapshot = {}
+        self._lock = threading.Lock()
+
+    def script(self, host=None):
+        sections = ['echo "{0}sockets"; (netstat -lntup || ss -lntup) 2>&1'
+                    .format(self.SECTION)]
+        for service in self.services:
+            sections.append('echo "{0}service {1}"; service {1} status 2>&1; '
+                            'echo "@@calyptos-rc $?"'.format(self.SECTION,
+                                                             service))
+        sections.append('echo "{0}disk"; df -P -k 2>&1'.format(self.SECTION))
+        sections.append('echo "{0}memory"; free -k 2>&1'.format(self.SECTION))
+        files = ['echo "{0}files"'.format(self.SECTION)]
+        if self.paths:
+            files.append("find {0} -xdev -maxdepth {1} -printf '%u %g %m %p\\n' "
+                         "2>/dev/null".format(' '.join(self.paths), self.depth))
+        if self.recursive_paths:
+            files.append("find {0} -xdev -printf '%u %g %m %p\\n' 2>/dev/null"
+                         .format(' '.join(self.recursive_paths)))
+        sections.append('; '.join(files))
+        for name, command in sorted(self.commands.get(host, {}).iteritems()):
+            sections.append('echo "{0}command {1}"; ({2}) 2>&1; '
+                            'echo "@@calyptos-rc $?"'.format(self.SECTION,
+                                                             name, command))
+        sections.append('true')
+        return '; '.join(sections)
+
+    def gather(self, hosts):
+        """
+        Collect facts for any of the hosts that are not in the snapshot yet
+        and return the facts for all of them
+        """
+        hosts = list(hosts)
+        with self._lock:
+            missing = [host for host in hosts if host not in self.snapshot]
+            scripts = dict((host, self.script(host)) for host in missing)
+            for batch in self.host_limiter.batches(missing):
+                with self.host_limiter.slots(len(batch)):
+                    with hide('everything'):
+                        outputs = fabric_execute(gather_facts_task,
+                                                 scripts=scripts, hosts=batch)
+                for host, output in outputs.iteritems():
+                    self.snapshot[host] = self.parse(str(output))
+            return dict((host, self.snapshot[host]) for host in hosts)
+
+    def get(self, host):
+        return self.gather([host])[host]
+
+    def parse(self, output):
+        facts = {'sockets': [], 'services': {}, 'disk': {}, 'memory': {},
+                 'files': {}, 'commands': {}}
+        sections = []
+        for line in output.splitlines():
+            match = self.SECTION_REGEX.match(line.strip())
+            if match:
+                sections.append((match.group(1), match.group(2), []))
+            elif sections:
+                sections[-1][2].append(line)
+        for name, argument, lines in sections:
+            if name == 'sockets':
+                facts['sockets'] = self._parse_sockets(lines)
+            elif name == 'service':
+                facts['services'][argument] = self._parse_service(lines)
+            elif name == 'disk':
+                facts['disk'] = self._parse_disk(lines)
+            elif name == 'memory':
+                facts['memory'] = self._parse_memory(lines)
+            elif name == 'files':
+                facts['files'] = self._parse_files(lines)
+            elif name == 'command':
+                facts['commands'][argument] = self._parse_command(lines)
+        return facts
+
+    def _parse_sockets(self, lines):
+        # Each listening socket becomes [proto, address, port, process] from
+        # either netstat -lntup or ss -lntup output
+        sockets = []
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 5 or not fields[0].startswith(('tcp', 'udp')):
+                continue
+            # netstat has numeric queue sizes where ss has the socket state
+            local_address = fields[3] if fields[1].isdigit() else fields[4]
+            address, _, port = local_address.rpartition(':')
+            if not port.isdigit():
+                continue
+            process = fields[-1]
+            if '/' not in process and 'users:' not in process:
+                process = ''
+            sockets.append([fields[0][:3], address, int(port), process])
+        return sockets
+
+    def _parse_command(self, lines):
+        return_code = None
+        output = []
+        for line in lines:
+            match = self.RETURN_CODE_REGEX.match(line.strip())
+            if match:
+                return_code = int(match.group(1))
+            else:
+                output.append(line)
+        return {'output': '\n'.join(output), 'return_code': return_code}
+
+    def _parse_service(self, lines):
+        result = self._parse_command(lines)
+        return {'output': result['output'],
+                'running': result['return_code'] == 0}
+
+    def _parse_disk(self, lines):
+        # df -P -k: Filesystem 1024-blocks Used Available Capacity Mounted on
+        disk = {}
+        for line in lines[1:]:
+            fields = line.split()
+            if len(fields) < 6 or not fields[4].endswith('%'):
+                continue
+            disk[' '.join(fields[5:])] = {'size_kb': int(fields[1]),
+                                          'used_kb': int(fields[2]),
+                                          'available_kb': int(fields[3]),
+                                          'used_percent': int(fields[4][:-1])}
+        return disk
+
+    def _parse_memory(self, lines):
+        memory = {}
+        header = []
+        for line in lines:
+            fields = line.split()
+            if not fields:
+                continue
+            if fields[0] == 'total':
+                header = fields
+            elif fields[0] == 'Mem:':
+                memory.update(zip(header, [int(value) for value in fields[1:]]))
+            elif fields[0] == '-/+':
+                # Older procps reports memory free of buffers/cache here
+                memory['available'] = int(fields[3])
+        if 'available' not in memory and 'free' in memory:
+            memory['available'] = memory['free']
+        return memory
+
+    def _parse_files(self, lines):
+        files = {}
+        for line in lines:
+            fields = line.split(None, 3)
+            if len(fields) == 4:
+                files[fields[3]] = {'owner': fields[0], 'group': fields[1],
+                                    'mode': fields[2]}
+        return files
+
+    def command(self, host, name):
+        # {'output', 'return_code'} of one of the host's commands, None if
+        # it was not gathered
+        return self.get(host).get('commands', {}).get(name)
+
+    def disk_usage(self, host, path):
+        # Usage of the filesystem holding path, found by longest mount match
+        disk = self.get(host)['disk']
+        mounts = [mount for mount in disk
+                  if path == mount or path.startswith(mount.rstrip('/') + '/')]
+        if not mounts:
+            return None
+        return disk[max(mounts, key=len)]
+
+    def save(self, filename):
+        with open(filename, 'w') as facts_file:
+            json.dump(self.snapshot, facts_file, indent=4, sort_keys=True)
+
+    def load(self, filename):
+        with open(filename) as facts_file:
+            self.snapshot.update(json.load(facts_file))
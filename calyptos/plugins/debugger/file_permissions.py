@@ -1,32 +1,101 @@
-from fabric.context_managers import hide, show
-import re
 from calyptos.plugins.debugger.debuggerplugin import DebuggerPlugin
+from calyptos.plugins.debugger.facts import HostFacts
 
 
 class FilePermissions(DebuggerPlugin):
-    def debug(self):
-        euca_hosts = self.component_deployer.get_euca_hosts()
-        roles = self.component_deployer.get_roles()
-        common_files = {'eucalyptus': ['/var/lib/eucalyptus',
-                                    '/var/log/eucalyptus'],
-                        'root': []}
+    # Used when the config file has no debugger: file_permissions: section.
+    # Rules are listed per role, 'all' applies to every Eucalyptus host.
+    DEFAULT_POLICY = {'all': [{'path': '/var/lib/eucalyptus',
+                               'owner': 'eucalyptus'},
+                              {'path': '/var/log/eucalyptus',
+                               'owner': 'eucalyptus'}]}
+    # Number of offending files to list for a rule before summarizing
+    MAX_REPORTED = 5
 
-        for host in euca_hosts:
-            self._check_file_owner(host, common_files)
-            if host in roles['clc']:
-                pass
-            if host in roles['node-controller']:
-                pass
+    def __init__(self, component_deployer, collector=None, host_limiter=None,
+                 facts=None, config=None):
+        if facts is None:
+            # Run on its own, gather only what the policy checks
+            paths, recursive_paths = self.fact_paths(config or {})
+            facts = HostFacts(paths=paths, recursive_paths=recursive_paths,
+                              host_limiter=host_limiter)
+        DebuggerPlugin.__init__(self, component_deployer, collector,
+                                host_limiter, facts, config)
 
+    @classmethod
+    def fact_paths(cls, config):
+        """
+        Return the paths the policy in the debugger config checks and those
+        of them checked recursively, for gathering their facts
+        """
+        policy = config.get('file_permissions') or cls.DEFAULT_POLICY
+        paths = set()
+        recursive_paths = set()
+        for rules in policy.itervalues():
+            for rule in rules:
+                path = rule['path'].rstrip('/')
+                paths.add(path)
+                if rule.get('recursive'):
+                    recursive_paths.add(path)
+        return sorted(paths), sorted(recursive_paths)
 
+    def debug(self):
+        euca_hosts = self.component_deployer.get_euca_hosts()
+        policy = self.config.get('file_permissions') or self.DEFAULT_POLICY
+        # Collect ownership for every host in one pass
+        host_facts = self.facts.gather(euca_hosts)
 
+        for host in sorted(euca_hosts):
+            for rule in self._rules_for_host(host, policy):
+                self._check_rule(host, rule, host_facts[host]['files'])
         return (self.passed, self.failed)
 
-    def _check_file_owner(self, host, path_dict):
-        for owner, paths in path_dict.iteritems():
-            for path in paths:
-                stat_output = self.run_command_on_host('stat -c %U ' + path, host=host)
-                if re.search(owner, stat_output):
-                    self.success(host + ': File permisssions correct for ' + path)
-                else:
-                    self.failure(host + ': File permisssions incorrect for ' + path)
+    def _rules_for_host(self, host, policy):
+        rules = []
+        for role, role_rules in policy.iteritems():
+            if role == 'all' or host in self.roles.get(role, []):
+                rules.extend(role_rules)
+        return rules
+
+    def _check_rule(self, host, rule, files):
+        path = rule['path'].rstrip('/')
+        if path not in files:
+            self.failure(host + ': Unable to find ' + path)
+            return
+        if rule.get('recursive'):
+            prefix = path + '/'
+            paths = [name for name in files
+                     if name == path or name.startswith(prefix)]
+        else:
+            paths = [path]
+        violations = []
+        for name in sorted(paths):
+            problem = self._violation(rule, files[name])
+            if problem:
+                violations.append(name + ' ' + problem)
+        if not violations:
+            self.success(host + ': File permisssions correct for ' + path +
+                         ' (' + str(len(paths)) + ' checked)')
+            return
+        self.failure(host + ': File permisssions incorrect for ' + path +
+                     ' (' + str(len(violations)) + ' of ' + str(len(paths)) +
+                     ')')
+        for violation in violations[:self.MAX_REPORTED]:
+            self.info(host + ':   ' + violation)
+
+    @staticmethod
+    def _violation(rule, file_info):
+        problems = []
+        if 'owner' in rule and file_info['owner'] != rule['owner']:
+            problems.append('owner ' + file_info['owner'])
+        if 'group' in rule and file_info['group'] != rule['group']:
+            problems.append('group ' + file_info['group'])
+        if 'max_mode' in rule:
+            # YAML reads an unquoted 0750 as an octal integer already
+            max_mode = rule['max_mode']
+            if not isinstance(max_mode, int):
+                max_mode = int(max_mode, 8)
+            # Permission bits granted beyond the most permissive allowed mode
+            if int(file_info['mode'], 8) & ~max_mode:
+                problems.append('mode ' + file_info['mode'])
+        return ', '.join(problems)
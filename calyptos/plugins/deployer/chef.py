@@ -1,48 +1,91 @@
 import json
 from fabric.operations import local
-from fabric.colors import red, green
+from fabric.colors import red, green, yellow
 import yaml
 from deployerplugin import DeployerPlugin
 from fabric.context_managers import hide, warn_only
-from fabric.tasks import execute
-from calyptos.chefmanager import ChefManager
+from calyptos.chefmanager import ChefManager, FailedToFindNodeException
+from calyptos.cookbooks import CookbookIndex
+from calyptos.files import write_if_changed
+from calyptos.planner import Estimator, Stage
 import os
 from calyptos.rolebuilder import RoleBuilder
+from calyptos.timings import DEFAULT_DATABASE, TimingDatabase
+from calyptos.transfer import MIN_MEASURED_BYTES, TransferPolicy, format_bytes
+from calyptos.workspace import DEFAULT_WORKSPACE_DIR, Workspace
 
 
 class Chef(DeployerPlugin):
     def __init__(self, password, environment_file='etc/environment.yml',
                  config_file='config.yml', debug=False, branch='euca-4.1',
                  cookbook_repo='https://github.com/eucalyptus/eucalyptus-cookbook'):
-        self.chef_repo_dir = 'chef-repo'
         self.environment_file = environment_file
         if debug:
             self.hidden_outputs = []
         else:
             self.hidden_outputs = ['running', 'stdout', 'stderr']
+        self.config = self.get_chef_config(config_file)
+        self.branch = branch
         self.role_builder = RoleBuilder(environment_file)
         self.roles = self.role_builder.get_roles()
         self.all_hosts = self.roles['all']
+        # Every environment is deployed from its own workspace
+        self.workspace = Workspace(
+            self.role_builder.read_environment()['name'],
+            self.config.get('workspace_dir', DEFAULT_WORKSPACE_DIR))
+        self.chef_repo_dir = self.workspace.chef_repo_dir.rstrip('/')
         self._prepare_fs(cookbook_repo, branch, debug)
+        self._import_legacy_nodes()
+        self.cookbook_index = CookbookIndex(self.workspace.cookbooks_dir)
         self.environment_name = self._write_json_environment()
         self.chef_manager = ChefManager(password, self.environment_name,
-                                        self.roles['all'])
-        self.config = self.get_chef_config(config_file)
+                                        self.roles['all'],
+                                        workspace=self.workspace)
+        try:
+            self.timings = TimingDatabase(self.config.get('timings_db',
+                                                          DEFAULT_DATABASE))
+        except Exception as e:
+            # Deploying matters more than keeping its history
+            print red('Unable to record timings: ' + str(e))
+            self.timings = None
+        self.timing_run = None
+        self.transfer_policy = TransferPolicy(
+            **(self.config.get('transfer') or {}))
 
     def _prepare_fs(self, cookbook_repo, branch, debug):
         ChefManager.install_chef_dk()
-        ChefManager.create_chef_repo()
+        ChefManager.create_chef_repo(self.workspace.chef_repo_dir)
+        # The cookbook repo is fetched once into a mirror that every
+        # workspace clones from, each checking out its own branch
+        mirror = self.workspace.mirror_path(cookbook_repo)
+        checkout = self.workspace.path('eucalyptus-cookbook')
         with hide(*self.hidden_outputs):
-            local('if [ ! -d eucalyptus-cookbook ]; then '
+            with self.workspace.shared_lock(os.path.basename(mirror)):
+                local('if [ ! -d {1} ]; then '
+                      'git clone --mirror {0} {1}; '
+                      'else git --git-dir={1} remote update --prune; '
+                      'fi'.format(cookbook_repo, mirror))
+            local('if [ ! -d {1} ]; then '
                   'git clone '
-                  '{0} eucalyptus-cookbook;'
-                  'fi'.format(cookbook_repo))
-            local('cd eucalyptus-cookbook; git checkout {0};'.format(branch))
-            local('cd eucalyptus-cookbook; git pull origin {0};'.format(branch))
-        ChefManager.download_cookbooks('eucalyptus-cookbook/Berksfile',
-                                       os.path.join(self.chef_repo_dir +
-                                                    '/cookbooks'),
-                                       debug=debug)
+                  '{0} {1};'
+                  'fi'.format(mirror, checkout))
+            local('cd {0}; git checkout {1};'.format(checkout, branch))
+            local('cd {0}; git pull origin {1};'.format(checkout, branch))
+        ChefManager.download_cookbooks(
+            os.path.join(checkout, 'Berksfile'), self.workspace.cookbooks_dir,
+            debug=debug, stamp_file=self.workspace.path('cookbooks.stamp'))
+
+    def _import_legacy_nodes(self):
+        # Deployments used to be made from a chef-repo in the current
+        # directory, pushed to /root/<directory name>/ on the hosts
+        imported = self.workspace.import_legacy_nodes()
+        if imported:
+            print yellow('Imported {0} node file(s) from {1} into {2}. '
+                         'The hosts keep their old copy in /root/{3}/, '
+                         'which can be removed once deployed from here.'
+                         .format(len(imported), os.path.abspath('chef-repo'),
+                                 self.workspace.chef_repo_dir,
+                                 os.path.basename(os.getcwd())))
 
     @staticmethod
     def get_chef_config(config_file):
@@ -55,20 +98,144 @@ class Chef(DeployerPlugin):
         else:
             raise IndexError('Unable to find deployer section of config file')
 
-    def _get_recipe_list(self, component):
-        for recipe_dict in self.config['roles']:
+    @staticmethod
+    def recipe_list(config, component):
+        for recipe_dict in config['roles']:
             if component in recipe_dict:
                 return recipe_dict[component]
         raise ValueError('No component found for: ' + component)
 
+    @staticmethod
+    def role_recipes(config):
+        recipes = {}
+        for recipe_dict in config.get('roles') or []:
+            recipes.update(recipe_dict)
+        return recipes
+
+    def _get_recipe_list(self, component):
+        return self.recipe_list(self.config, component)
+
+    @classmethod
+    def bootstrap_stages(cls, roles, config):
+        # Install CLC and Initialize DB
+        stages = []
+        if roles['mon-bootstrap']:
+            mon_bootstrap = roles['mon-bootstrap']
+            stages.append(Stage('mon-bootstrap', mon_bootstrap, [
+                (mon_bootstrap, cls.recipe_list(config, 'mon-bootstrap'))],
+                clear=True))
+        if roles['riak-head']:
+            riak_head = roles['riak-head']
+            stages.append(Stage('riak-head', riak_head, [
+                (riak_head, cls.recipe_list(config, 'riak-head'))],
+                clear=True))
+        if roles['midolman']:
+            midolman_hosts = roles['midolman']
+            stages.append(Stage('midolman', midolman_hosts, [
+                (midolman_hosts, ['midokura::midolman'])]))
+        if roles['clc']:
+            clc = roles['clc']
+            stages.append(Stage('clc', clc, [
+                (clc, cls.recipe_list(config, 'clc'))], clear=True))
+        return stages
+
+    @classmethod
+    def provision_stages(cls, roles, config, network_mode):
+        # Install all other components and configure CLC
+        additions = []
+        for role_dict in config['roles']:
+            component_name = role_dict.keys().pop()
+            additions.append((roles[component_name],
+                              cls.recipe_list(config, component_name)))
+        stages = [Stage('provision', roles['all'], additions, clear=True)]
+        if roles['riak-head']:
+            riak_head = roles['riak-head']
+            stages.append(Stage('riak-commit', riak_head, [
+                (riak_head, ['riakcs-cluster::plancommit',
+                             'riakcs-cluster::mergecreds'])]))
+        if roles['clc']:
+            clc = roles['clc']
+            stages.append(Stage('configure', clc, [
+                (clc, ['eucalyptus::configure'])]))
+            if network_mode == 'VPCMIDO':
+                midonet_api = roles['midonet-api']
+                create_resources = 'midokura::create-first-resources'
+                stages.append(Stage('midonet-resources', midonet_api, [
+                    (midonet_api, [create_resources])]))
+        return stages
+
+    @classmethod
+    def uninstall_stages(cls, roles):
+        recipes = []
+        if roles['clc']:
+            recipes.append('eucalyptus::nuke')
+        if roles['riak-head']:
+            recipes.append('riakcs-cluster::nuke')
+        if roles['mon-bootstrap']:
+            recipes.append('ceph-cluster::nuke')
+        if roles['haproxy']:
+            recipes.append('haproxy::nuke')
+        return [Stage('uninstall', roles['all'], [(roles['all'], recipes)],
+                      clear=True)]
+
+    @staticmethod
+    def network_mode(role_builder):
+        euca_attributes = role_builder.get_euca_attributes() or {}
+        return euca_attributes.get('network', {}).get('mode')
+
+    @classmethod
+    def plan(cls, environment_file, config_file, operation):
+        """
+        Return the stages of a bootstrap, provision or uninstall without
+        touching any host
+        """
+        config = cls.get_chef_config(config_file)
+        role_builder = RoleBuilder(environment_file)
+        roles = role_builder.get_roles()
+        if operation == 'bootstrap':
+            return cls.bootstrap_stages(roles, config)
+        if operation == 'provision':
+            return cls.provision_stages(roles, config,
+                                        cls.network_mode(role_builder))
+        if operation == 'uninstall':
+            return cls.uninstall_stages(roles)
+        raise ValueError('Unable to plan operation: ' + operation)
+
+    def _run_stages(self, stages, operation):
+        if self.timings:
+            self.timing_run = self.timings.start_run(self.environment_name,
+                                                     operation, self.branch)
+        status = 'failed'
+        try:
+            for stage in stages:
+                if stage.clear:
+                    self.chef_manager.clear_run_list(self.all_hosts)
+                for hosts, recipes in stage.additions:
+                    self.chef_manager.add_to_run_list(hosts, recipes)
+                self._run_chef_on_hosts(stage.hosts, stage.name)
+            status = 'passed'
+        finally:
+            if self.timings:
+                self.timings.finish_run(self.timing_run, status)
+            self.timing_run = None
+
+    @staticmethod
+    def render_environment(environment_dict):
+        # Canonical JSON, the same environment always renders the same bytes
+        return json.dumps(environment_dict, indent=4, sort_keys=True,
+                          separators=(',', ': ')) + '\n'
+
     def _write_json_environment(self):
-        environment_dict = yaml.load(open(self.environment_file).read())
+        # Only rewrite the environment when it changed so that rsync and
+        # anything else watching the chef-repo sees no churn
+        environment_dict = self.role_builder.read_environment()
         current_environment = environment_dict['name']
-        environment_dir = self.chef_repo_dir + '/environments/'
+        environment_dir = self.workspace.environments_dir
         filename = environment_dir + current_environment + '.json'
-        with open(filename, 'w') as env_json:
-            env_json.write(json.dumps(environment_dict, indent=4,
-                                      sort_keys=True, separators=(',', ': ')))
+        self.environment_hash, changed = write_if_changed(
+            filename, self.render_environment(environment_dict))
+        if changed:
+            print green('Updated environment ' + filename)
         return current_environment
 
     def _get_environment(self):
@@ -76,95 +243,177 @@ class Chef(DeployerPlugin):
                   self.environment_name + '.json') as env_file:
             return json.loads(env_file.read())
 
-    def _run_chef_on_hosts(self, hosts):
+    def _run_list(self, machine):
+        try:
+            node_name = self.chef_manager.get_node_name_by_ip(machine)
+        except FailedToFindNodeException:
+            return []
+        return self.chef_manager.node_hash[node_name].get('run_list', [])
+
+    def _record_timings(self, stage, results):
+        if not self.timings or self.timing_run is None:
+            return
+        host_runs = []
+        for machine, result in results.iteritems():
+            roles = self.role_builder.host_index.get(machine, {}).get('roles', [])
+            run_list = self._run_list(machine)
+            status = 'passed' if result.succeeded else 'failed'
+            host_runs.append((machine, roles, run_list,
+                              getattr(result, 'started', None),
+                              getattr(result, 'duration', None), status))
+        self.timings.record_hosts(self.timing_run, stage, host_runs)
+
+    def _cookbook_excludes(self, hosts):
+        """
+        Return {host: [cookbook, ...]} of the vendored cookbooks that none
+        of the host's roles nor its current run list need
+        """
+        if not self.config.get('cookbook_subsets', True):
+            return {}
+        # The recipes of each role are resolved once per role, not per host
+        role_cookbooks = {}
+        excludes = {}
+        for host in hosts:
+            needed = self.cookbook_index.closure(self._run_list(host))
+            roles = self.role_builder.host_index.get(host, {}).get('roles', [])
+            for role in roles:
+                if role not in role_cookbooks:
+                    try:
+                        role_cookbooks[role] = self.cookbook_index.closure(
+                            self._get_recipe_list(role))
+                    except ValueError:
+                        role_cookbooks[role] = set()
+                needed |= role_cookbooks[role]
+            excludes[host] = sorted(self.cookbook_index.names - needed)
+        return excludes
+
+    def _longest_first(self, hosts):
+        # When there are more hosts than pool slots, start the chef runs
+        # expected to take longest first so they do not stretch the tail
+        recorded = {}
+        if self.timings:
+            recorded = self.timings.host_seconds(self.environment_name)
+        host_roles = dict((host, index['roles']) for host, index
+                          in self.role_builder.host_index.iteritems())
+        estimator = Estimator(recorded=recorded, host_roles=host_roles,
+                              role_recipes=self.role_recipes(self.config),
+                              **(self.config.get('estimates') or {}))
+        return estimator.longest_first(dict(
+            (host, self._run_list(host)) for host in hosts))
+
+    def _push_deployment_data(self, hosts, stage):
+        rates = {}
+        if self.timings:
+            rates = self.timings.push_rates(self.environment_name,
+                                            MIN_MEASURED_BYTES)
+        transfer_options = self.transfer_policy.options(
+            hosts, rates, self.chef_manager.fabric_env['pool_size'])
         with hide(*self.hidden_outputs):
-            execute(self.chef_manager.push_deployment_data, hosts=hosts)
+            results = self.chef_manager.execute(
+                self.chef_manager.push_deployment_data, hosts=hosts,
+                cookbook_excludes=self._cookbook_excludes(hosts),
+                transfer_options=transfer_options)
+        self._report_pushes(stage, results)
+        return results
+
+    def _report_pushes(self, stage, results):
+        pushes = [(host, result.bytes_sent or 0, result.started,
+                   result.duration, result.compress_level, result.file_bytes,
+                   result.bwlimit)
+                  for host, result in results.iteritems()
+                  if getattr(result, 'duration', None) is not None]
+        if not pushes:
+            return
+        total = sum(push[1] for push in pushes)
+        wall_time = max(push[2] + push[3] for push in pushes) - min(
+            push[2] for push in pushes)
+        slowest = min(pushes, key=lambda push: push[1] / max(push[3], 0.001))
+        print green('Pushed {0} to {1} host(s) in {2:.1f}s, {3}/s; slowest '
+                    '{4} at {5}/s'.format(
+                        format_bytes(total), len(pushes), wall_time,
+                        format_bytes(total / max(wall_time, 0.001)),
+                        slowest[0],
+                        format_bytes(slowest[1] / max(slowest[3], 0.001))))
+        if self.timings:
+            self.timings.record_pushes(self.environment_name,
+                                       self.timing_run, stage, pushes)
+
+    def _run_chef_on_hosts(self, hosts, stage='chef'):
+        hosts = self._longest_first(hosts)
+        self._push_deployment_data(hosts, stage)
         with warn_only():
-            results = execute(self.chef_manager.run_chef_client, hosts=hosts)
+            results = self.chef_manager.execute(
+                self.chef_manager.run_chef_client, hosts=hosts)
         failed = False
         for machine, result in results.iteritems():
             if result.succeeded:
                 print green('Success on host: ' + machine)
             if result.failed:
                 failed = True
-                fail_log_name = 'calyptos-failure-' + machine + '.log'
+                fail_log_name = self.workspace.path(
+                    'calyptos-failure-' + machine + '.log')
                 print red('Chef Client failed on ' + machine + ' log available at ' +  fail_log_name)
                 with open(fail_log_name, 'w') as file:
                     file.write(result.stdout)
+        self._record_timings(stage, results)
         if failed:
             exit(1)
-        execute(self.chef_manager.pull_node_info, hosts=hosts)
+        self.chef_manager.pull_node_info(hosts)
         return results
 
     def prepare(self):
-        self.chef_manager.sync_ssh_key(self.all_hosts)
+        # Only the steps a host is missing are redone, so preparing a
+        # prepared environment again costs one probe per host
+        hosts = self._longest_first(self.all_hosts)
+        with hide(*self.hidden_outputs):
+            readiness = self.chef_manager.readiness(hosts)
+        write_if_changed(self.workspace.path('readiness.json'), json.dumps(
+            readiness, indent=4, sort_keys=True) + '\n')
+        stale = [host for host in hosts
+                 if readiness[host]['environment_hash'] not in
+                 (None, self.environment_hash)]
+        if stale:
+            print yellow('{0} host(s) have an out of date copy of environment '
+                         '{1}, it is pushed with their next chef run: {2}'
+                         .format(len(stale), self.environment_name,
+                                 ', '.join(stale)))
+        unreachable = [host for host in hosts
+                       if not (readiness[host]['key'] and
+                               readiness[host]['rsync'])]
+        if unreachable:
+            self.chef_manager.sync_ssh_key(unreachable)
         self.chef_manager.clear_run_list(self.all_hosts)
-        order = [self.chef_manager.push_deployment_data,
-                 self.chef_manager.bootstrap_chef,
-                 self.chef_manager.run_chef_client,
-                 self.chef_manager.pull_node_info]
-        for method in order:
-            with hide(*self.hidden_outputs):
-                execute(method, hosts=self.all_hosts)
+        # Hosts whose node file came from before workspaces have converged
+        unconverged = [host for host in hosts
+                       if not readiness[host]['converged'] and
+                       not self.chef_manager.has_local_node(host)]
+        without_chef = [host for host in unconverged
+                        if not readiness[host]['chef_version']]
+        print green('{0} of {1} host(s) already prepared'.format(
+            len(hosts) - len(unconverged), len(hosts)))
+        if unconverged:
+            self._push_deployment_data(unconverged, 'prepare')
+        with hide(*self.hidden_outputs):
+            if without_chef:
+                self.chef_manager.execute(self.chef_manager.bootstrap_chef,
+                                          hosts=without_chef)
+            if unconverged:
+                self.chef_manager.execute(self.chef_manager.run_chef_client,
+                                          hosts=unconverged)
+        missing = [host for host in hosts if host in unconverged or
+                   not self.chef_manager.has_local_node(host)]
+        if missing:
+            self.chef_manager.pull_node_info(missing)
 
     def bootstrap(self):
-        # Install CLC and Initialize DB
-        if self.roles['mon-bootstrap']:
-            mon_bootstrap = self.roles['mon-bootstrap']
-            self.chef_manager.clear_run_list(self.all_hosts)
-            self.chef_manager.add_to_run_list(mon_bootstrap, self._get_recipe_list('mon-bootstrap'))
-            self._run_chef_on_hosts(mon_bootstrap)
-
-        if self.roles['riak-head']:
-            riak_head = self.roles['riak-head']
-            self.chef_manager.clear_run_list(self.all_hosts)
-            self.chef_manager.add_to_run_list(riak_head, self._get_recipe_list('riak-head'))
-            self._run_chef_on_hosts(riak_head)
-
-        if self.roles['midolman']:
-            midolman_hosts = self.roles['midolman']
-            self.chef_manager.add_to_run_list(midolman_hosts, ['midokura::midolman'])
-            self._run_chef_on_hosts(midolman_hosts)
-
-        if self.roles['clc']:
-            self.chef_manager.clear_run_list(self.all_hosts)
-            clc = self.roles['clc']
-            self.chef_manager.add_to_run_list(clc, self._get_recipe_list('clc'))
-            self._run_chef_on_hosts(clc)
+        self._run_stages(self.bootstrap_stages(self.roles, self.config),
+                         'bootstrap')
 
     def provision(self):
-        # Install all other components and configure CLC
-        self.chef_manager.clear_run_list(self.all_hosts)
-        for role_dict in self.config['roles']:
-            component_name = role_dict.keys().pop()
-            self.chef_manager.add_to_run_list(self.roles[component_name],
-                                              self._get_recipe_list(component_name))
-        self._run_chef_on_hosts(self.all_hosts)
-
-        if self.roles['riak-head']:
-            riak_head = self.roles['riak-head']
-            self.chef_manager.add_to_run_list(riak_head, ['riakcs-cluster::plancommit', 'riakcs-cluster::mergecreds'])
-            self._run_chef_on_hosts(riak_head)
-
-        if self.roles['clc']:
-            clc = self.roles['clc']
-            self.chef_manager.add_to_run_list(clc, ['eucalyptus::configure'])
-            self._run_chef_on_hosts(clc)
-            if self.role_builder.get_euca_attributes()['network']['mode'] == 'VPCMIDO':
-                midonet_api = self.roles['midonet-api']
-                create_resources = 'midokura::create-first-resources'
-                self.chef_manager.add_to_run_list(midonet_api, [create_resources])
-                self._run_chef_on_hosts(midonet_api)
+        self._run_stages(self.provision_stages(
+            self.roles, self.config, self.network_mode(self.role_builder)),
+            'provision')
 
     def uninstall(self):
-        self.chef_manager.clear_run_list(self.all_hosts)
-        if self.roles['clc']:
-            self.chef_manager.add_to_run_list(self.all_hosts, ['eucalyptus::nuke'])
-        if self.roles['riak-head']:
-            self.chef_manager.add_to_run_list(self.all_hosts, ['riakcs-cluster::nuke'])
-        if self.roles['mon-bootstrap']:
-            self.chef_manager.add_to_run_list(self.all_hosts, ['ceph-cluster::nuke'])
-        if self.roles['haproxy']:
-            self.chef_manager.add_to_run_list(self.all_hosts, ['haproxy::nuke'])
-        self._run_chef_on_hosts(self.all_hosts)
-        local('rm -rf ./chef-repo/nodes/*')
+        self._run_stages(self.uninstall_stages(self.roles), 'uninstall')
+        local('rm -rf ' + self.workspace.nodes_dir + '*')
@@ -0,0 +1,91 @@
+import yaml
+
+
+class Optional(object):
+    """
+    Marks a key in a schema definition that does not have to be present
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+
+class CompiledMapping(object):
+    """
+    A schema mapping compiled into lookups: every known key with the check
+    for its value, and the set of keys that are required
+    """
+    __slots__ = ('fields', 'required')
+
+    def __init__(self, fields, required):
+        self.fields = fields
+        self.required = required
+
+
+def compile_schema(definition):
+    """
+    Compile a schema definition, a nested dict whose leaves are the types
+    the values must have, into CompiledMapping objects
+    """
+    if not isinstance(definition, dict):
+        return definition
+    fields = {}
+    required = set()
+    for key, value in definition.iteritems():
+        if isinstance(key, Optional):
+            key = key.key
+        else:
+            required.add(key)
+        fields[key] = compile_schema(value)
+    return CompiledMapping(fields, frozenset(required))
+
+
+def find_violations(schema, document, name='environment.yml'):
+    """
+    Walk the document once against a compiled schema and return every
+    violation as a (path, message) tuple, path being a tuple of keys
+    """
+    violations = []
+    stack = [(schema, document, ())]
+    while stack:
+        spec, value, path = stack.pop()
+        key = path[-1] if path else name
+        invalid = "Invalid {0} value(s) for '{1}'.".format(name, key)
+        if not isinstance(spec, CompiledMapping):
+            if not isinstance(value, spec):
+                violations.append((path, invalid))
+            continue
+        if not isinstance(value, dict):
+            violations.append((path, invalid))
+            continue
+        for missing in sorted(spec.required.difference(value)):
+            violations.append((path, "Missing key '{0}' in '{1}'."
+                                     .format(missing, key)))
+        for child_key, child_value in value.iteritems():
+            child_spec = spec.fields.get(child_key)
+            if child_spec is None:
+                violations.append((path + (child_key,),
+                                   "Unexpected key '{0}' in '{1}'."
+                                   .format(child_key, key)))
+            else:
+                stack.append((child_spec, child_value, path + (child_key,)))
+    return sorted(violations)
+
+
+def line_numbers(stream):
+    """
+    Map the path of every mapping key in a YAML document to the line it is
+    defined on
+    """
+    lines = {(): 1}
+    root = yaml.compose(stream)
+    stack = [(root, ())]
+    while stack:
+        node, path = stack.pop()
+        if not isinstance(node, yaml.MappingNode):
+            continue
+        for key_node, value_node in node.value:
+            key_path = path + (key_node.value,)
+            lines[key_path] = key_node.start_mark.line + 1
+            stack.append((value_node, key_path))
+    return lines
@@ -1,17 +1,75 @@
+from calyptos.parallel import map_concurrently
 from calyptos.plugins.validator.validatorplugin import ValidatorPlugin
 import os
+import socket
+import subprocess
+import time
 
 class PingHosts(ValidatorPlugin):
+    network_bound = True
+    # Used when the config file has no validator: pinghosts: section
+    DEFAULT_OPTIONS = {'methods': ['tcp', 'icmp'],
+                       'port': 22,
+                       'timeout': 2,
+                       'concurrency': 100}
+
     def validate(self):
-        for host in self.component_deployer.all_hosts:
-            if self._ping(host, count=3):
-                self.success('Ping to ' + host)
+        options = dict(self.DEFAULT_OPTIONS)
+        options.update(self.config.get('pinghosts') or {})
+        hosts = sorted(self.component_deployer.all_hosts)
+        results = map_concurrently(
+            lambda host: self._timed_reach(host, options), hosts,
+            max_workers=options['concurrency'])
+        unreachable = []
+        for host in hosts:
+            reached, seconds = results[host]
+            if reached is True:
+                self.success('Ping to ' + host, host=host, check='Ping',
+                             duration=seconds)
+            else:
+                self.failure('Ping to ' + host + ' - ' + str(reached),
+                             host=host, check='Ping', duration=seconds)
+                unreachable.append(host)
+        if unreachable:
+            raise AssertionError('Unable to reach hosts: ' +
+                                 ', '.join(unreachable))
+
+    def _timed_reach(self, host, options):
+        # The result of _reach and how many seconds it took
+        start = time.time()
+        return self._reach(host, options), time.time() - start
+
+    def _reach(self, host, options):
+        # A host is reachable if any of the configured methods gets through,
+        # otherwise return why each of them failed
+        errors = []
+        for method in options['methods']:
+            if method == 'tcp':
+                if self._connect(host, options['port'], options['timeout']):
+                    return True
+                errors.append('no TCP connection on port ' +
+                              str(options['port']))
+            elif method == 'icmp':
+                if self._ping(host, timeout=options['timeout']):
+                    return True
+                errors.append('no ICMP reply')
             else:
-                self.failure('Ping to ' + host)
-                raise AssertionError('Unable to ping host: ' + host)
+                errors.append('unknown method ' + method)
+        return ', '.join(errors)
+
+    def _connect(self, host, port, timeout):
+        try:
+            connection = socket.create_connection((host, port), timeout)
+        except (socket.error, socket.timeout):
+            return False
+        connection.close()
+        return True
 
-    def _ping(self, host, count=1):
-        exit_code = os.system('ping -c {0} {1}'.format(count, host))
+    def _ping(self, host, count=1, timeout=2):
+        with open(os.devnull, 'w') as devnull:
+            exit_code = subprocess.call(['ping', '-c', str(count),
+                                         '-W', str(timeout), host],
+                                        stdout=devnull, stderr=devnull)
         if exit_code != 0:
             return False
         else:
@@ -1,22 +1,184 @@
+from calyptos.parallel import map_concurrently
 from calyptos.plugins.validator.validatorplugin import ValidatorPlugin
-from urllib2 import Request, urlopen, URLError
+from urllib2 import Request, HTTPError, HTTPRedirectHandler, URLError, build_opener
+from urlparse import urljoin
+from xml.etree import ElementTree
+import json
+import os
+import socket
+import threading
+import time
+
+
+class HeadRequest(Request):
+    def get_method(self):
+        return 'HEAD'
+
+
+class HeadRedirectHandler(HTTPRedirectHandler):
+    # urllib2 follows redirects with a GET, keep asking for headers only
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        redirected = HTTPRedirectHandler.redirect_request(self, req, fp, code,
+                                                          msg, headers, newurl)
+        if redirected is not None and req.get_method() == 'HEAD':
+            return HeadRequest(redirected.get_full_url(),
+                               headers=redirected.headers)
+        return redirected
 
 
 class Repos(ValidatorPlugin):
+    network_bound = True
+    # Used when the config file has no validator: repos: section
+    DEFAULT_OPTIONS = {'timeout': 10,
+                       'concurrency': 10,
+                       'cache_file': '~/.calyptos/cache/repos.json',
+                       'cache_ttl': 300,
+                       'max_metadata_age_days': 30}
+    # Repos that are yum repositories and so carry repodata/repomd.xml
+    YUM_REPOS = ['enterprise-repo', 'euca2ools-repo', 'eucalyptus-repo']
+    REPOMD_NAMESPACE = '{http://linux.duke.edu/metadata/repo}'
+
     def validate(self):
         eucalyptus_attributes = self.environment['default_attributes']['eucalyptus']
         self.repotypes = ['enterprise-repo', 'default-img-url', 'euca2ools-repo', 'eucalyptus-repo', 'init-script-url', 'post-script-url']
+        self.options = dict(self.DEFAULT_OPTIONS)
+        self.options.update(self.config.get('repos') or {})
+        self.opener = build_opener(HeadRedirectHandler)
         self.repos = []
+        yum_repos = []
         for val in self.repotypes:
             if val in eucalyptus_attributes:
                 self.repos.append(eucalyptus_attributes[val])
+                if val in self.YUM_REPOS:
+                    yum_repos.append(eucalyptus_attributes[val])
+        self.cache = self._load_cache()
+        self._cache_lock = threading.Lock()
+        results = map_concurrently(self._check_url, self.repos,
+                                   max_workers=self.options['concurrency'])
+        invalid = []
         for url in self.repos:
-            req = Request(url)
-            try:
-                response = urlopen(req)
+            error = results[url]
+            if error:
+                self.failure('INVALID URL: ' + str(url) + '  ' + str(error))
+                invalid.append(url)
+            else:
                 self.success('URL: ' + str(url) + ' is valid and reachable!')
-            except URLError, e:
-                if hasattr(e, 'reason'):
-                    raise AssertionError("INVALID URL: " + str(url) + "  " + str(e.reason))
-                elif hasattr(e, 'code'):
-                    raise AssertionError("INVALID REQUEST: " + str(url) + "  " + str(e.code))
+        fresh_repos = [url for url in yum_repos if url not in invalid]
+        ages = map_concurrently(self._metadata_age, fresh_repos,
+                                max_workers=self.options['concurrency'])
+        unreadable = [url for url in fresh_repos
+                      if not self._report_metadata_age(url, ages[url])]
+        self._save_cache()
+        problems = []
+        if invalid:
+            problems.append('INVALID URLS: ' + ', '.join(invalid))
+        if unreadable:
+            problems.append('UNREADABLE REPO METADATA: ' +
+                            ', '.join(unreadable))
+        if problems:
+            raise AssertionError('; '.join(problems))
+
+    def _check_url(self, url):
+        """
+        Return None if url is reachable, otherwise the reason it is not. Only
+        headers are requested unless the server refuses HEAD.
+        """
+        if self._cached(url):
+            return None
+        try:
+            try:
+                response = self.opener.open(HeadRequest(url),
+                                            timeout=self.options['timeout'])
+            except HTTPError as e:
+                if e.code not in (405, 501):
+                    raise
+                # HEAD is not allowed, the body of the GET is never read
+                response = self.opener.open(Request(url),
+                                            timeout=self.options['timeout'])
+            final_url = response.geturl()
+            response.close()
+        except HTTPError as e:
+            return 'HTTP ' + str(e.code)
+        except URLError as e:
+            return e.reason
+        except (socket.timeout, socket.error) as e:
+            return e
+        with self._cache_lock:
+            # Where redirects led, so that the metadata is read from there
+            self.cache[url] = {'checked': time.time(), 'final_url': final_url}
+        return None
+
+    def _cached(self, url):
+        # The cache entry for url if it is still fresh
+        with self._cache_lock:
+            entry = self.cache.get(url)
+        if (isinstance(entry, dict) and
+                time.time() - entry['checked'] < self.options['cache_ttl']):
+            return entry
+        return None
+
+    def _metadata_age(self, url):
+        # Age in seconds of the newest metadata listed in the repo's repomd.xml
+        entry = self._cached(url) or {}
+        if 'timestamp' not in entry:
+            entry['timestamp'] = self._metadata_timestamp(
+                entry.get('final_url') or url)
+            with self._cache_lock:
+                if url in self.cache:
+                    self.cache[url] = entry
+        return time.time() - entry['timestamp']
+
+    def _metadata_timestamp(self, url):
+        repomd_url = urljoin(url.rstrip('/') + '/', 'repodata/repomd.xml')
+        response = self.opener.open(Request(repomd_url),
+                                    timeout=self.options['timeout'])
+        try:
+            repomd = ElementTree.fromstring(response.read())
+        finally:
+            response.close()
+        timestamps = [float(element.text) for element in
+                      repomd.iter(self.REPOMD_NAMESPACE + 'timestamp')]
+        if not timestamps:
+            raise ValueError('no timestamps in ' + repomd_url)
+        return max(timestamps)
+
+    def _report_metadata_age(self, url, age):
+        # Return whether the metadata could be read
+        if isinstance(age, Exception):
+            self.failure('Unable to read repo metadata for ' + str(url) +
+                         '  ' + str(age))
+            return False
+        days = int(age / 86400)
+        max_days = self.options['max_metadata_age_days']
+        if max_days is not None and days > max_days:
+            self.warning('Repo metadata for ' + str(url) + ' is ' +
+                         str(days) + ' days old')
+        else:
+            self.success('Repo metadata for ' + str(url) + ' is ' +
+                         str(days) + ' days old')
+        return True
+
+    def _load_cache(self):
+        # Only successful checks are cached, failures are always retried.
+        # Each entry is {'checked': time, 'final_url': url} and, once read,
+        # the newest repo metadata 'timestamp'.
+        cache_file = os.path.expanduser(self.options['cache_file'])
+        try:
+            with open(cache_file) as cache:
+                return json.load(cache)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_cache(self):
+        cache_file = os.path.expanduser(self.options['cache_file'])
+        now = time.time()
+        fresh = dict((url, entry) for url, entry in self.cache.iteritems()
+                     if isinstance(entry, dict) and
+                     now - entry['checked'] < self.options['cache_ttl'])
+        try:
+            if not os.path.isdir(os.path.dirname(cache_file)):
+                os.makedirs(os.path.dirname(cache_file))
+            with open(cache_file, 'w') as cache:
+                json.dump(fresh, cache)
+        except (IOError, OSError):
+            pass
@@ -1,107 +1,92 @@
 from calyptos.plugins.validator.validatorplugin import ValidatorPlugin
-from schema import Schema, And, Or, Use, Optional
+from calyptos.plugins.validator.envschema import (Optional, compile_schema,
+                                                  find_violations,
+                                                  line_numbers)
+
+# Each leaf is the type the value must have, keys not listed are rejected
+ENVIRONMENT_SCHEMA = {
+    'description': str,
+    'name': str,
+    Optional('cookbook_versions'): dict,
+    Optional('override_attributes'): dict,
+    'default_attributes': {
+        'eucalyptus': {
+            'network': {
+                'mode': str,
+                Optional('config-json'): {
+                    'PublicIps': list,
+                    Optional('Clusters'): list,
+                    Optional('InstanceDnsServers'): list,
+                    Optional('Mode'): str,
+                },
+                'bridge-interface': str,
+                Optional('bridged-nic'): str,
+                Optional('public-interface'): str,
+                Optional('private-interface'): str,
+                Optional('nc-router'): str,
+            },
+            'topology': {
+                'clusters': dict,
+                'clc-1': str,
+                Optional('walrus'): str,
+                'user-facing': list,
+                Optional('riakcs'): {
+                    'access-key': str,
+                    'admin-email': str,
+                    'admin-name': str,
+                    'endpoint': str,
+                    'port': int,
+                    'secret-key': str,
+                },
+            },
+            'eucalyptus-repo': str,
+            'euca2ools-repo': str,
+            Optional('default-img-url'): str,
+            Optional('enterprise-repo'): str,
+            Optional('init-script-url'): str,
+            Optional('post-script-url'): str,
+            Optional('yum-options'): str,
+            Optional('nc'): dict,
+            Optional('install-imaging-worker'): str,
+            Optional('install-load-balancer'): str,
+            Optional('install-type'): str,
+            Optional('log-level'): str,
+            Optional('source-branch'): str,
+            Optional('source-repo'): str,
+            Optional('system-properties'): dict,
+        },
+    },
+}
+
+COMPILED_SCHEMA = compile_schema(ENVIRONMENT_SCHEMA)
+
 
 class Structure(ValidatorPlugin):
     def validate(self):
         self.envdata = self.environment
-        self.schema = Schema(
-            {
-                'description': And(str, error="Invalid environment.yml value(s) for 'description'."),
-                'name': And(str, error="Invalid environment.yml value(s) for 'name'."),
-                Optional('cookbook_versions'):
-                    And(dict, error="Invalid environment.yml value(s) for 'cookbook_versions'."),
-                Optional('override_attributes'):
-                    And(dict, error="Invalid environment.yml value(s) for 'override_attributes'."),
-                'default_attributes':
-                    {
-                        'eucalyptus':
-                            {
-                                'network':
-                                    {
-                                        'mode': And(str, error="Invalid environment.yml value(s) for 'mode'."),
-                                        Optional('config-json'):
-                                            {
-                                                'PublicIps':
-                                                    And(list, error="Invalid environment.yml value(s) for 'PublicIps'."),
-                                                Optional('Clusters'):
-                                                    And(list, error="Invalid environment.yml value(s) for 'Clusters'."),
-                                                Optional('InstanceDnsServers'):
-                                                    And(list, error="Invalid environment.yml value(s) for 'InstanceDnsServers'."),
-                                                Optional('Mode'):
-                                                    And(str, error="Invalid environment.yml value(s) for 'Mode'."),
-                                            },
-                                        'bridge-interface':
-                                            And(str, error="Invalid environment.yml value(s) for 'bridge-interface'."),
-                                        Optional('bridged-nic'):
-                                            And(str, error="Invalid environment.yml value(s) for 'bridge-nic'."),
-                                        Optional('public-interface'):
-                                            And(str, error="Invalid environment.yml value(s) for 'public-interface'."),
-                                        Optional('private-interface'):
-                                            And(str, error="Invalid environment.yml value(s) for 'private-interface'."),
-                                        Optional('nc-router'):
-                                            And(str, error="Invalid environment.yml value(s) for 'nc-router'."),
-                                    },
-                                'topology':
-                                    {
-                                        'clusters': And(dict, error="Invalid environment.yml value(s) for 'clusters'."),
-                                        'clc-1': And(str, error="Invalid environment.yml value(s) for 'clc-1'."),
-                                        Optional('walrus'):
-                                            And(str, error="Invalid environment.yml value(s) for 'walrus'."),
-                                        'user-facing':
-                                            And(list, error="Invalid environment.yml value(s) for 'user-facing'."),
-                                        Optional('riakcs'): {
-                                            'access-key':
-                                                And(str, error="Invalid environment.yml value(s) for 'access-key'."),
-                                            'admin-email':
-                                                And(str, error="Invalid environment.yml value(s) for 'admin-email'."),
-                                            'admin-name':
-                                                And(str, error="Invalid environment.yml value(s) for 'admin-name'."),
-                                            'endpoint':
-                                                And(str, error="Invalid environment.yml value(s) for 'endpoint'."),
-                                            'port':
-                                                And(int, error="Invalid environment.yml value(s) for 'port'."),
-                                            'secret-key':
-                                                And(str, error="Invalid environment.yml value(s) for 'secret-key'."),
-                                        }
-                                    },
-                                'eucalyptus-repo':
-                                    And(str, error="Invalid environment.yml value(s) for 'eucalyptus-repo'."),
-                                'euca2ools-repo':
-                                    And(str, error="Invalid environment.yml value(s) for 'euca2ools-repo'."),
-                                Optional('default-img-url'):
-                                    And(str, error="Invalid environment.yml value(s) for 'default-img-url'."),
-                                Optional('enterprise-repo'):
-                                    And(str, error="Invalid environment.yml value(s) for 'enterprise-repo'."),
-                                Optional('init-script-url'):
-                                    And(str, error="Invalid environment.yml value(s) for 'init-script-url'."),
-                                Optional('post-script-url'):
-                                    And(str, error="Invalid environment.yml value(s) for 'post-script-url'."),
-                                Optional('yum-options'):
-                                    And(str, error="Invalid environment.yml value(s) for 'yum-options'."),
-                                Optional('nc'):
-                                    And(dict, error="Invalid environment.yml value(s)(s) for 'nc'."),
-                                Optional('install-imaging-worker'):
-                                    And(str, error="Invalid environment.yml value(s) for 'install-imaging-worker'."),
-                                Optional('install-load-balancer'):
-                                    And(str, error="Invalid environment.yml value(s) for 'install-load-balancer'."),
-                                Optional('install-type'):
-                                    And(str, error="Invalid environment.yml value(s) for 'install-type'."),
-                                Optional('log-level'):
-                                    And(str, error="Invalid environment.yml value(s) for 'log-level'."),
-                                Optional('source-branch'):
-                                    And(str, error="Invalid environment.yml value(s) for 'source-branch'."),
-                                Optional('source-repo'):
-                                    And(str, error="Invalid environment.yml value(s) for 'source-repo'."),
-                                Optional('system-properties'):
-                                    And(dict, error="Invalid environment.yml value(s) for 'system-properties'.")
-                            }
-                    }
-            }
-        )
-        self.validated = self.schema.validate(self.envdata)
-        try:
-            assert self.validated
+        violations = find_violations(COMPILED_SCHEMA, self.envdata)
+        if not violations:
             self.success("environment.yml file appears to be valid.")
-        except AssertionError, e:
-            self.failure("environment.yml is invalid!: " + str(e))
+            return
+        lines = self._line_numbers()
+        for path, message in violations:
+            self.failure("environment.yml line {0}: {1}".format(
+                self._line(lines, path), message))
+        raise AssertionError("environment.yml is invalid!: " +
+                             str(len(violations)) + " problem(s) found")
+
+    def _line_numbers(self):
+        # Only re-read the file for line numbers once something is wrong
+        environment_file = getattr(self.component_deployer,
+                                   'environment_file', None)
+        if not environment_file:
+            return {(): '?'}
+        with open(environment_file) as env_file:
+            return line_numbers(env_file)
 
+    @staticmethod
+    def _line(lines, path):
+        # Fall back to the closest enclosing key that has a known line
+        while path not in lines:
+            path = path[:-1]
+        return lines[path]
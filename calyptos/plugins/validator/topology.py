@@ -1,11 +1,14 @@
 from calyptos.plugins.validator.validatorplugin import ValidatorPlugin
 
 class Topology(ValidatorPlugin):
+    # Used when the config file has no validator: topology: section
+    CONFLICTING_ROLES = [['node-controller', 'cluster-controller']]
+
     def validate(self):
         self.failed_hosts = []
         self.good_hosts = []
-        # Check each cluster
-        self._single_cluster_per_host()
+        # Check each host, every violation is reported before failing
+        problems = self._single_cluster_per_host() + self._conflicting_roles()
 
         riakcs_keys_master = ['access-key', 'admin-email', 'admin-name', 'endpoint', 'port', 'secret-key']
         self.topology = self.environment['default_attributes']['eucalyptus']['topology']
@@ -29,31 +32,44 @@ class Topology(ValidatorPlugin):
             self.success('Cluster ' + name + ' has both an SC and CC')
             assert self.topology['clusters'][name]['nodes']
             self.success('Cluster ' + name + ' has node controllers')
-
+        if problems:
+            raise AssertionError('; '.join(problems))
 
 
     def _single_cluster_per_host(self):
-        cluster_hosts = self.roles['cluster']
-        for name, hosts in cluster_hosts.iteritems():
-            # Check that each host...
-            for host in hosts:
-                # Only appears in one cluster
-                appearances = []
-                for cluster in cluster_hosts.keys():
-                    if host in cluster:
-                        appearances.append(cluster)
-                if len(appearances) > 1:
-                    raise AssertionError("Found " + host + " in multiple clusters: " + str(
-                            appearances))
-                else:
-                    self.success(host + " only in 1 cluster")
-                    self.good_hosts.append(host)
-
-
-
-
-
-
-
-
+        host_index = self.component_deployer.host_index
+        duplicates = []
+        for host in sorted(host_index):
+            # Only appears in one cluster
+            appearances = sorted(host_index[host]['clusters'])
+            if len(appearances) > 1:
+                self.failure("Found " + host + " in multiple clusters: " +
+                             str(appearances), host=host,
+                             check="Single cluster per host")
+                duplicates.append(host)
+            elif appearances:
+                self.success(host + " only in 1 cluster", host=host,
+                             check="Single cluster per host")
+                self.good_hosts.append(host)
+        if duplicates:
+            return ["Found hosts in multiple clusters: " +
+                    ", ".join(duplicates)]
+        return []
 
+    def _conflicting_roles(self):
+        options = self.config.get('topology') or {}
+        conflicts = options.get('conflicting_roles', self.CONFLICTING_ROLES)
+        host_index = self.component_deployer.host_index
+        conflicted = []
+        for host in sorted(host_index):
+            host_roles = host_index[host]['roles']
+            for conflict in conflicts:
+                if host_roles.issuperset(conflict):
+                    self.failure(host + " has conflicting roles: " +
+                                 " and ".join(conflict), host=host,
+                                 check="Conflicting roles")
+                    conflicted.append(host)
+        if conflicted:
+            return ["Found hosts with conflicting roles: " +
+                    ", ".join(conflicted)]
+        return []
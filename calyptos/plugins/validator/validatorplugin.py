@@ -1,15 +1,21 @@
 # stevedore/example/base.py
 import abc
-from fabric.colors import red, green, cyan
+from fabric.colors import red, green, cyan, yellow
 import six
+from calyptos.results import ResultCollector
 
 
 @six.add_metaclass(abc.ABCMeta)
 class ValidatorPlugin(object):
     """Base class for example plugin used in the tutorial.
     """
+    # Validators that wait on the network are run apart from the pure ones
+    network_bound = False
 
-    def __init__(self, component_deployer):
+    def __init__(self, component_deployer, config=None, collector=None):
+        # The validator section of the calyptos config file
+        self.config = config or {}
+        self.collector = collector or ResultCollector()
         self.message_style = "[{0: <20}] {1}"
         self.name = self.__class__.__name__
         self.component_deployer = component_deployer
@@ -17,12 +23,21 @@ class ValidatorPlugin(object):
         self.roles = self.component_deployer.get_roles()
         print cyan(self.message_style.format('TEST STARTING', self.name))
 
-    def success(self, message):
+    def success(self, message, host=None, check=None, duration=None):
+        self.collector.record(self.name, 'passed', message, host=host,
+                              check=check, duration=duration)
         print green(self.message_style.format('VALIDATION PASSED', message))
 
-    def failure(self, message):
+    def failure(self, message, host=None, check=None, duration=None):
+        self.collector.record(self.name, 'failed', message, host=host,
+                              check=check, duration=duration)
         print red(self.message_style.format('VALIDATION FAILED', message))
 
+    def warning(self, message, host=None, check=None, duration=None):
+        self.collector.record(self.name, 'warnings', message, host=host,
+                              check=check, duration=duration)
+        print yellow(self.message_style.format('VALIDATION WARNING', message))
+
     def report(self, failed, passed):
         print cyan(self.message_style.format('TEST RESULTS',
                                              "Name: {0} Passed: "
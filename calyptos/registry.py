@@ -0,0 +1,230 @@
+import importlib
+import json
+import logging
+import os
+import sys
+
+LOG = logging.getLogger(__name__)
+
+# Entry points of every namespace, saved with the fingerprint of the
+# installed packages they were read from
+CACHE_FILE = os.path.expanduser('~/.calyptos/cache/plugins.json')
+
+
+def installed_fingerprint(metadata_files=()):
+    """
+    Return the mtimes of every sys.path entry and of the given
+    entry_points.txt files. Installing or removing a package changes the
+    mtime of its sys.path directory and re-developing one changes its
+    entry_points.txt, so a stat of each is enough to notice either.
+    """
+    fingerprint = []
+    for path in sys.path + list(metadata_files):
+        path = os.path.abspath(path or os.curdir)
+        try:
+            fingerprint.append([path, os.path.getmtime(path)])
+        except OSError:
+            continue
+    return fingerprint
+
+
+def _metadata_files():
+    # Every entry_points.txt directly inside the sys.path directories
+    metadata_files = []
+    for path in sys.path:
+        path = os.path.abspath(path or os.curdir)
+        try:
+            if not os.path.isdir(path):
+                continue
+            for name in sorted(os.listdir(path)):
+                if name.endswith(('.egg-info', '.dist-info')):
+                    entry_points = os.path.join(path, name, 'entry_points.txt')
+                    if os.path.isfile(entry_points):
+                        metadata_files.append(entry_points)
+        except OSError:
+            continue
+    return metadata_files
+
+
+def _scan_entry_points(namespace):
+    import pkg_resources
+    return [[entry_point.name,
+             entry_point.module_name + ':' + '.'.join(entry_point.attrs)]
+            for entry_point in pkg_resources.iter_entry_points(namespace)]
+
+
+def _load_cache():
+    try:
+        with open(CACHE_FILE) as cache:
+            return json.load(cache)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_cache(cache):
+    try:
+        if not os.path.isdir(os.path.dirname(CACHE_FILE)):
+            os.makedirs(os.path.dirname(CACHE_FILE))
+        with open(CACHE_FILE, 'w') as cache_file:
+            json.dump(cache, cache_file)
+    except (IOError, OSError):
+        pass
+
+
+def entry_points(namespace, refresh=False):
+    """
+    Return [name, 'module:attribute'] for every plugin in the namespace,
+    only scanning the installed distributions when they have changed
+    """
+    cache = _load_cache()
+    metadata_files = cache.get('metadata_files') or []
+    if cache.get('fingerprint') != installed_fingerprint(metadata_files):
+        metadata_files = _metadata_files()
+        cache = {'fingerprint': installed_fingerprint(metadata_files),
+                 'metadata_files': metadata_files, 'namespaces': {}}
+    namespaces = cache.setdefault('namespaces', {})
+    if refresh or namespace not in namespaces:
+        namespaces[namespace] = _scan_entry_points(namespace)
+        _save_cache(cache)
+    return namespaces[namespace]
+
+
+def resolve(target):
+    # Import 'module:attribute' without going through pkg_resources
+    module_name, _, attrs = target.partition(':')
+    obj = importlib.import_module(module_name)
+    for attr in attrs.split('.') if attrs else []:
+        obj = getattr(obj, attr)
+    return obj
+
+
+class NoMatches(RuntimeError):
+    pass
+
+
+class Extension(object):
+    """
+    A loaded plugin, with the same attributes as a stevedore Extension
+    apart from entry_point, which would need pkg_resources
+    """
+
+    def __init__(self, name, target, plugin, obj):
+        self.name = name
+        self.entry_point_target = target
+        self.plugin = plugin
+        self.obj = obj
+
+
+class ExtensionManager(object):
+    """
+    The loaded plugins of a namespace, used like a stevedore
+    ExtensionManager
+    """
+
+    def __init__(self, namespace, extensions, propagate_map_exceptions=False):
+        self.namespace = namespace
+        self.extensions = extensions
+        self.propagate_map_exceptions = propagate_map_exceptions
+
+    def names(self):
+        return [extension.name for extension in self.extensions]
+
+    def __iter__(self):
+        return iter(self.extensions)
+
+    def __len__(self):
+        return len(self.extensions)
+
+    def map(self, func, *args, **kwds):
+        if not self.extensions:
+            raise NoMatches('No %s extensions found' % self.namespace)
+        response = []
+        for extension in self.extensions:
+            try:
+                response.append(func(extension, *args, **kwds))
+            except Exception as err:
+                if self.propagate_map_exceptions:
+                    raise
+                LOG.error('error calling %r: %s', extension.name, err)
+        return response
+
+
+class DriverManager(ExtensionManager):
+    @property
+    def driver(self):
+        return self.extensions[0].obj
+
+
+def _load_extensions(namespace, names, invoke_args, invoke_kwds,
+                     refresh=False):
+    # Import and instantiate only the selected plugins
+    extensions = []
+    moved = []
+    for name, target in entry_points(namespace, refresh=refresh):
+        if names is not None and name not in names:
+            continue
+        try:
+            plugin = resolve(target)
+        except (ImportError, AttributeError):
+            if not refresh:
+                # The cached entry point may have moved, tried again below
+                moved.append(name)
+                continue
+            raise
+        try:
+            obj = plugin(*invoke_args, **invoke_kwds)
+        except (KeyboardInterrupt, AssertionError):
+            raise
+        except Exception as err:
+            # The same as stevedore does for plugins that fail to load
+            LOG.error('Could not load %r: %s', name, err,
+                      exc_info=LOG.isEnabledFor(logging.DEBUG))
+            continue
+        extensions.append(Extension(name, target, plugin, obj))
+    if moved:
+        # Only the plugins that failed are looked up in a fresh scan
+        extensions.extend(_load_extensions(namespace, moved, invoke_args,
+                                           invoke_kwds, refresh=True))
+    return extensions
+
+
+def plugin_class(namespace, name):
+    """
+    Import and return the named plugin without invoking it
+    """
+    for refresh in (False, True):
+        for found, target in entry_points(namespace, refresh=refresh):
+            if found == name:
+                try:
+                    return resolve(target)
+                except (ImportError, AttributeError):
+                    if refresh:
+                        raise
+                    break
+    raise NoMatches('No %r plugin found, looking for %r' % (namespace, name))
+
+
+def extension_manager(namespace, names=None, invoke_args=(), invoke_kwds=None,
+                      propagate_map_exceptions=False):
+    """
+    Load every selected plugin of the namespace from the cached entry points
+    and invoke it
+    """
+    extensions = _load_extensions(namespace, names, invoke_args,
+                                  invoke_kwds or {})
+    return ExtensionManager(namespace, extensions,
+                            propagate_map_exceptions=propagate_map_exceptions)
+
+
+def driver_manager(namespace, name, invoke_args=(), invoke_kwds=None):
+    """
+    Load and invoke the named driver from the cached entry points
+    """
+    # A driver installed since the cache was written is found by a rescan
+    refresh = name not in [found for found, target in entry_points(namespace)]
+    extensions = _load_extensions(namespace, [name], invoke_args,
+                                  invoke_kwds or {}, refresh=refresh)
+    if not extensions:
+        raise NoMatches('No %r driver found, looking for %r' %
+                        (namespace, name))
+    return DriverManager(namespace, extensions[:1])
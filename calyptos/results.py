@@ -0,0 +1,111 @@
+from xml.etree import ElementTree
+import json
+import threading
+import time
+
+
+def _text(value):
+    # Command output is not guaranteed to be valid UTF-8
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+class ResultCollector(object):
+    """
+    Thread-safe tally of the successes, failures and warnings reported by
+    plugins that may be running concurrently. Every result is also kept as
+    a record and, when a stream is given, written to it as a JSON line.
+    """
+    STATUSES = ['passed', 'failed', 'warnings']
+
+    def __init__(self, stream=None):
+        self._lock = threading.Lock()
+        self.stream = stream
+        self.counts = {}
+        self.durations = {}
+        self.records = []
+
+    def _plugin_counts(self, plugin):
+        if plugin not in self.counts:
+            self.counts[plugin] = dict.fromkeys(self.STATUSES, 0)
+        return self.counts[plugin]
+
+    def record(self, plugin, status, message=None, host=None, check=None,
+               duration=None):
+        """
+        Tally a result. duration is how many seconds the check took when the
+        plugin measured it, None otherwise.
+        """
+        now = time.time()
+        if duration is not None:
+            duration = round(duration, 3)
+        with self._lock:
+            self._plugin_counts(plugin)[status] += 1
+            record = {'plugin': plugin,
+                      'host': host,
+                      'check': _text(check or message),
+                      'status': status,
+                      'duration': duration,
+                      'message': _text(message),
+                      'timestamp': now}
+            self.records.append(record)
+            if self.stream:
+                self.stream.write(json.dumps(record, sort_keys=True) + '\n')
+                self.stream.flush()
+
+    def count(self, plugin, status):
+        with self._lock:
+            return self._plugin_counts(plugin)[status]
+
+    def set_duration(self, plugin, seconds):
+        with self._lock:
+            self.durations[plugin] = seconds
+
+    def totals(self):
+        with self._lock:
+            totals = dict.fromkeys(self.STATUSES, 0)
+            for plugin_counts in self.counts.itervalues():
+                for status, count in plugin_counts.iteritems():
+                    totals[status] += count
+            return totals
+
+    def write_junit(self, stream, name='calyptos'):
+        """
+        Write the records as JUnit XML, one testsuite per plugin and one
+        testcase per result. Warnings are passing testcases with the
+        warning in their system-out.
+        """
+        with self._lock:
+            records = list(self.records)
+            durations = dict(self.durations)
+        suites = ElementTree.Element('testsuites', name=name)
+        by_plugin = {}
+        for record in records:
+            by_plugin.setdefault(record['plugin'], []).append(record)
+        for plugin in sorted(by_plugin):
+            plugin_records = by_plugin[plugin]
+            failures = [r for r in plugin_records if r['status'] == 'failed']
+            duration = durations.get(plugin, sum(r['duration'] or 0
+                                                 for r in plugin_records))
+            suite = ElementTree.SubElement(
+                suites, 'testsuite', name=plugin,
+                tests=str(len(plugin_records)), failures=str(len(failures)),
+                errors='0', time='{0:.3f}'.format(duration))
+            for record in plugin_records:
+                classname = plugin
+                if record['host']:
+                    classname += '.' + record['host'].replace('.', '_')
+                case = ElementTree.SubElement(
+                    suite, 'testcase', classname=classname,
+                    name=record['check'] or '')
+                if record['duration'] is not None:
+                    case.set('time', '{0:.3f}'.format(record['duration']))
+                if record['status'] == 'failed':
+                    failure = ElementTree.SubElement(
+                        case, 'failure', message=record['message'] or '')
+                    failure.text = record['message']
+                elif record['status'] == 'warnings':
+                    output = ElementTree.SubElement(case, 'system-out')
+                    output.text = 'WARNING: ' + (record['message'] or '')
+        ElementTree.ElementTree(suites).write(stream, encoding='UTF-8')
@@ -1,6 +1,149 @@
+import re
 import yaml
 
 
+class FrozenDict(dict):
+    """
+    A dict that refuses to be modified once built
+    """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('Environment snapshot is read-only')
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+
+class FrozenList(list):
+    """
+    A list that refuses to be modified once built
+    """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('Environment snapshot is read-only')
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _immutable
+    __iadd__ = __imul__ = _immutable
+    append = extend = insert = pop = remove = reverse = sort = _immutable
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.iteritems())
+    if isinstance(value, list):
+        return FrozenList(freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    return value
+
+
+ROLE_EXPRESSION_TOKENS = re.compile(r'\s*([&|,!()]|[^&|,!()\s]+)')
+
+
+def select_hosts(roles, expression):
+    """
+    Resolve a role expression to a set of hosts. Terms are role names,
+    cluster:<name> or hosts, combined with & (in both), | or , (in either)
+    and ! (not in), & binding tighter than | and parentheses grouping, e.g.
+    'node-controller & cluster:one'
+    """
+    tokens = ROLE_EXPRESSION_TOKENS.findall(expression)
+    position = [0]
+
+    def peek():
+        if position[0] < len(tokens):
+            return tokens[position[0]]
+        return None
+
+    def take():
+        token = peek()
+        if token is None:
+            raise ValueError('Unexpected end of role expression: ' + expression)
+        position[0] += 1
+        return token
+
+    def either():
+        hosts = both()
+        while peek() in ('|', ','):
+            take()
+            hosts = hosts | both()
+        return hosts
+
+    def both():
+        hosts = term()
+        while peek() == '&':
+            take()
+            hosts = hosts & term()
+        return hosts
+
+    def term():
+        token = take()
+        if token == '!':
+            return set(roles['all']) - term()
+        if token == '(':
+            hosts = either()
+            if take() != ')':
+                raise ValueError('Unbalanced parentheses in role expression: ' +
+                                 expression)
+            return hosts
+        if token.startswith('cluster:'):
+            cluster = token.split(':', 1)[1]
+            if cluster not in roles['cluster']:
+                raise ValueError('Unknown cluster: ' + cluster)
+            return set(roles['cluster'][cluster])
+        if token in roles and token != 'cluster':
+            return set(roles[token])
+        if token in roles['all']:
+            return set([token])
+        raise ValueError('Unknown role or host: ' + token)
+
+    hosts = either()
+    if peek() is not None:
+        raise ValueError('Unexpected "' + peek() + '" in role expression: ' +
+                         expression)
+    return hosts
+
+
+class EnvironmentSnapshot(object):
+    """
+    Read-only view of an environment and its roles, read once and shared by
+    plugins that may run concurrently
+    """
+
+    def __init__(self, role_builder):
+        self.environment_file = role_builder.environment_file
+        self.environment = freeze(role_builder.read_environment())
+        self.env_dict = self.environment['default_attributes']
+        self.roles = freeze(role_builder.get_roles())
+        self.all_hosts = self.roles['all']
+        self.host_index = freeze(role_builder.get_host_index(self.roles))
+
+    def snapshot(self):
+        # Already frozen, nothing to copy
+        return self
+
+    def select_hosts(self, expression):
+        return select_hosts(self.roles, expression)
+
+    def read_environment(self):
+        return self.environment
+
+    def get_all_attributes(self):
+        return self.env_dict
+
+    def get_euca_attributes(self):
+        return self.env_dict.get('eucalyptus')
+
+    def get_roles(self):
+        return self.roles
+
+    def get_euca_hosts(self):
+        euca_components = ['clc', 'user-facing', 'cluster-controller',
+                           'storage-controller', 'node-controller', 'walrus']
+        return set().union(*[self.roles[component]
+                             for component in euca_components])
+
+
 class RoleBuilder():
 
     # Global list of roles
@@ -26,6 +169,13 @@ class RoleBuilder():
         self.env_dict = self.get_all_attributes()
         self.roles = self.get_roles()
         self.all_hosts = self.roles['all']
+        self.host_index = self.get_host_index(self.roles)
+
+    def snapshot(self):
+        return EnvironmentSnapshot(self)
+
+    def select_hosts(self, expression):
+        return select_hosts(self.roles, expression)
 
     def read_environment(self):
         with open(self.environment_file) as env_file:
@@ -73,6 +223,29 @@ class RoleBuilder():
             all_hosts.update(roles[component])
         return all_hosts
 
+    def get_host_index(self, roles=None):
+        """
+        Invert the roles into a dict of host -> {'roles': set(),
+        'clusters': set()} in a single pass over every role membership
+        """
+        if roles is None:
+            roles = self.get_roles()
+        index = {}
+
+        def membership(host):
+            if host not in index:
+                index[host] = {'roles': set(), 'clusters': set()}
+            return index[host]
+        for role, hosts in roles.iteritems():
+            if role in ('all', 'cluster'):
+                continue
+            for host in hosts:
+                membership(host)['roles'].add(role)
+        for cluster, hosts in roles.get('cluster', {}).iteritems():
+            for host in hosts:
+                membership(host)['clusters'].add(cluster)
+        return index
+
     def get_roles(self):
         roles = self._initialize_roles()
         euca_attributes = self.get_euca_attributes()
@@ -150,8 +323,8 @@ class RoleBuilder():
                 roles['walrus'] = set()
 
             # Add cluster level components
+            roles['cluster'] = {}
             for name in topology['clusters']:
-                roles['cluster'] = {}
                 if 'cc-1' in topology['clusters'][name]:
                     cc = topology['clusters'][name]['cc-1']
                     roles['cluster-controller'].add(cc)
@@ -0,0 +1,209 @@
+import math
+import os
+import sqlite3
+import time
+
+DEFAULT_DATABASE = '~/.calyptos/timings.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    environment TEXT,
+    operation TEXT,
+    branch TEXT,
+    started REAL,
+    duration REAL,
+    status TEXT
+);
+CREATE TABLE IF NOT EXISTS host_runs (
+    run_id INTEGER REFERENCES runs(id),
+    stage TEXT,
+    host TEXT,
+    roles TEXT,
+    run_list TEXT,
+    started REAL,
+    duration REAL,
+    status TEXT
+);
+CREATE TABLE IF NOT EXISTS pushes (
+    environment TEXT,
+    run_id INTEGER,
+    stage TEXT,
+    host TEXT,
+    bytes INTEGER,
+    started REAL,
+    duration REAL,
+    compress_level INTEGER,
+    file_bytes INTEGER,
+    bwlimit INTEGER
+);
+CREATE INDEX IF NOT EXISTS host_runs_run ON host_runs(run_id);
+CREATE INDEX IF NOT EXISTS host_runs_host ON host_runs(host);
+CREATE INDEX IF NOT EXISTS pushes_host ON pushes(environment, host);
+"""
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of values, None if there are none
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(fraction * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+class TimingDatabase(object):
+    """
+    Durations and outcomes of every deployment run, stage and host chef run,
+    kept in SQLite so that they outlive the process
+    """
+
+    def __init__(self, path=DEFAULT_DATABASE):
+        self.path = os.path.expanduser(path)
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript(SCHEMA)
+        # Columns added since the first version of the table
+        columns = [row[1] for row in
+                   self.connection.execute('PRAGMA table_info(pushes)')]
+        with self.connection:
+            for column in ('file_bytes', 'bwlimit'):
+                if column not in columns:
+                    self.connection.execute(
+                        'ALTER TABLE pushes ADD COLUMN {0} INTEGER'
+                        .format(column))
+
+    def start_run(self, environment, operation, branch=None):
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO runs (environment, operation, branch, started, '
+                'status) VALUES (?, ?, ?, ?, ?)',
+                (environment, operation, branch, time.time(), 'running'))
+        return cursor.lastrowid
+
+    def finish_run(self, run_id, status):
+        with self.connection:
+            self.connection.execute(
+                'UPDATE runs SET duration = ? - started, status = ? '
+                'WHERE id = ?', (time.time(), status, run_id))
+
+    def record_hosts(self, run_id, stage, host_runs):
+        """
+        Record the chef run of every host in a stage from a list of
+        (host, roles, run_list, started, duration, status)
+        """
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO host_runs (run_id, stage, host, roles, run_list, '
+                'started, duration, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(run_id, stage, host, ','.join(sorted(roles)),
+                  ','.join(run_list), started, duration, status)
+                 for host, roles, run_list, started, duration, status
+                 in host_runs])
+
+    def record_pushes(self, environment, run_id, stage, pushes):
+        """
+        Record the deployment data pushes of a stage from a list of
+        (host, bytes, started, duration, compress_level, file_bytes, bwlimit)
+        where bytes went on the wire and file_bytes is their uncompressed size
+        """
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO pushes (environment, run_id, stage, host, bytes, '
+                'started, duration, compress_level, file_bytes, bwlimit) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(environment, run_id, stage) + tuple(push)
+                 for push in pushes])
+
+    def push_rates(self, environment, min_bytes=0, limit=5):
+        """
+        Median uncompressed bytes per second of the latest limit pushes to
+        each host that had no bandwidth limit and sent at least min_bytes of
+        files, as {host: rate}. Neither compression nor a cap then makes a
+        host look slower than its link.
+        """
+        rates = {}
+        for host, sent, duration in self.connection.execute(
+                'SELECT host, file_bytes, duration FROM pushes '
+                'WHERE environment = ? AND file_bytes >= ? AND duration > 0 '
+                'AND bwlimit IS NULL ORDER BY started DESC',
+                (environment, min_bytes)):
+            host_rates = rates.setdefault(host, [])
+            if len(host_rates) < limit:
+                host_rates.append(sent / duration)
+        return dict((host, percentile(values, 0.5))
+                    for host, values in rates.iteritems())
+
+    def host_seconds(self, environment=None):
+        """
+        Median duration of the successful chef runs of each host and run
+        list, as {(host, (recipe, ...)): seconds}
+        """
+        query = ('SELECT host_runs.host, host_runs.run_list, '
+                 'host_runs.duration FROM host_runs JOIN runs '
+                 'ON runs.id = host_runs.run_id '
+                 "WHERE host_runs.status = 'passed'")
+        parameters = ()
+        if environment:
+            query += ' AND runs.environment = ?'
+            parameters = (environment,)
+        durations = {}
+        for host, run_list, duration in self.connection.execute(query,
+                                                                parameters):
+            key = (host, tuple(run_list.split(',')) if run_list else ())
+            durations.setdefault(key, []).append(duration)
+        return dict((key, percentile(values, 0.5))
+                    for key, values in durations.iteritems())
+
+    def recent_runs(self, environment=None, limit=10):
+        query = ('SELECT id, environment, operation, branch, started, '
+                 'duration, status FROM runs')
+        parameters = ()
+        if environment:
+            query += ' WHERE environment = ?'
+            parameters = (environment,)
+        query += ' ORDER BY started DESC LIMIT ?'
+        return self.connection.execute(query,
+                                       parameters + (limit,)).fetchall()
+
+    def host_run_rows(self, environment=None):
+        # (stage, host, roles, duration, status, operation, branch) of
+        # every recorded host chef run
+        query = ('SELECT host_runs.stage, host_runs.host, host_runs.roles, '
+                 'host_runs.duration, host_runs.status, runs.operation, '
+                 'runs.branch FROM host_runs JOIN runs '
+                 'ON runs.id = host_runs.run_id')
+        parameters = ()
+        if environment:
+            query += ' WHERE runs.environment = ?'
+            parameters = (environment,)
+        return self.connection.execute(query, parameters).fetchall()
+
+    def branch_trends(self, environment=None):
+        """
+        Median duration of finished runs per operation and branch, oldest
+        branch first: [(operation, branch, runs, median seconds)]
+        """
+        query = ('SELECT operation, branch, started, duration FROM runs '
+                 "WHERE status = 'passed'")
+        parameters = ()
+        if environment:
+            query += ' AND environment = ?'
+            parameters = (environment,)
+        query += ' ORDER BY started'
+        trends = {}
+        order = []
+        for operation, branch, started, duration in self.connection.execute(
+                query, parameters):
+            key = (operation, branch)
+            if key not in trends:
+                trends[key] = []
+                order.append(key)
+            trends[key].append(duration)
+        return [(operation, branch, len(trends[(operation, branch)]),
+                 percentile(trends[(operation, branch)], 0.5))
+                for operation, branch in order]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,81 @@
+import re
+
+STATS = re.compile(r'^(Total bytes sent|Total transferred file size):'
+                   r'\s*([\d,.]+)', re.MULTILINE)
+
+# Pushes smaller than this are dominated by latency, not by the link
+MIN_MEASURED_BYTES = 1024 * 1024
+
+
+def transfer_stats(rsync_output):
+    """
+    Return (bytes put on the wire, uncompressed bytes of the files sent)
+    from the output of rsync --stats, None for any that is missing
+    """
+    stats = dict((name, int(value.replace(',', '').split('.')[0]))
+                 for name, value in STATS.findall(rsync_output or ''))
+    return (stats.get('Total bytes sent'),
+            stats.get('Total transferred file size'))
+
+
+def format_bytes(count):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(count) < 1024 or unit == 'GB':
+            break
+        count /= 1024.0
+    if unit == 'B':
+        return '{0}B'.format(int(count))
+    return '{0:.1f}{1}'.format(count, unit)
+
+
+class TransferPolicy(object):
+    """
+    Chooses the rsync compression level and bandwidth limit of each host's
+    push. With compression set to 'auto', hosts whose past uncapped pushes
+    went slower than auto_compress_below_kib_per_sec are compressed and the
+    others are not, since on a fast link compression only costs CPU. Rates
+    and limits are in KiB (1024 bytes) per second, as rsync's --bwlimit.
+    """
+
+    def __init__(self, compression='auto', compress_level=6,
+                 unmeasured_compress_level=1,
+                 auto_compress_below_kib_per_sec=10240,
+                 bwlimit_kib_per_sec=None, aggregate_bwlimit_kib_per_sec=None):
+        self.compression = compression
+        self.compress_level = compress_level
+        self.unmeasured_compress_level = unmeasured_compress_level
+        self.auto_compress_below_kib_per_sec = auto_compress_below_kib_per_sec
+        self.bwlimit_kib_per_sec = bwlimit_kib_per_sec
+        self.aggregate_bwlimit_kib_per_sec = aggregate_bwlimit_kib_per_sec
+
+    def host_compress_level(self, rate):
+        # rate is the host's measured uncompressed bytes per second, None
+        # if unknown
+        if self.compression == 'auto':
+            if rate is None:
+                return self.unmeasured_compress_level
+            if rate < self.auto_compress_below_kib_per_sec * 1024:
+                return self.compress_level
+            return 0
+        if self.compression is True:
+            return self.compress_level
+        return int(self.compression or 0)
+
+    def host_bwlimit(self, concurrent):
+        # The aggregate cap is shared by the hosts pushed to at once
+        limits = [limit for limit in (self.bwlimit_kib_per_sec,) if limit]
+        if self.aggregate_bwlimit_kib_per_sec:
+            limits.append(max(1, self.aggregate_bwlimit_kib_per_sec //
+                              max(1, concurrent)))
+        return min(limits) if limits else None
+
+    def options(self, hosts, rates=None, pool_size=20):
+        """
+        Return {host: {'compress_level': level, 'bwlimit': KiB/s or None}}
+        """
+        rates = rates or {}
+        bwlimit = self.host_bwlimit(min(pool_size, len(hosts)))
+        return dict((host, {'compress_level':
+                            self.host_compress_level(rates.get(host)),
+                            'bwlimit': bwlimit})
+                    for host in hosts)
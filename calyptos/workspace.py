@@ -0,0 +1,79 @@
+from contextlib import contextmanager
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import shutil
+
+DEFAULT_WORKSPACE_DIR = '~/.calyptos/workspaces'
+
+
+class Workspace(object):
+    """
+    Directory an environment is deployed from. Each environment has its own
+    chef-repo and cookbook checkout, pushed to its own folder on the hosts,
+    so that several environments can be deployed at once from one machine.
+    Clones of cookbook repositories are shared between workspaces.
+    """
+
+    def __init__(self, environment_name, base_dir=DEFAULT_WORKSPACE_DIR):
+        self.environment_name = environment_name
+        self.base_dir = os.path.abspath(os.path.expanduser(base_dir))
+        self.root = os.path.join(self.base_dir, environment_name)
+        self.shared_dir = os.path.join(self.base_dir, '.shared')
+        self.chef_repo_dir = os.path.join(self.root, 'chef-repo') + '/'
+        self.nodes_dir = self.chef_repo_dir + 'nodes/'
+        self.environments_dir = self.chef_repo_dir + 'environments/'
+        self.cookbooks_dir = self.chef_repo_dir + 'cookbooks'
+        self.remote_folder_path = '/root/calyptos-' + environment_name + '/'
+        for directory in (self.root, self.shared_dir):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def import_legacy_nodes(self, legacy_chef_repo_dir='chef-repo/'):
+        """
+        Copy the node files of this environment from a chef-repo in the
+        current directory, where deployments were made from before
+        workspaces, into an empty workspace. Returns the files copied.
+        """
+        nodes_dir = os.path.join(self.chef_repo_dir, 'nodes')
+        legacy_nodes_dir = os.path.abspath(os.path.join(legacy_chef_repo_dir,
+                                                        'nodes'))
+        if (os.path.abspath(nodes_dir) == legacy_nodes_dir or
+                glob.glob(os.path.join(nodes_dir, '*.json'))):
+            return []
+        imported = []
+        for node_file in sorted(glob.glob(os.path.join(legacy_nodes_dir,
+                                                       '*.json'))):
+            try:
+                with open(node_file) as node:
+                    environment = json.load(node).get('chef_environment')
+            except (IOError, ValueError):
+                continue
+            if environment not in (None, '_default', self.environment_name):
+                continue
+            if not os.path.isdir(nodes_dir):
+                os.makedirs(nodes_dir)
+            shutil.copy2(node_file, nodes_dir)
+            imported.append(node_file)
+        return imported
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def mirror_path(self, repo_url):
+        # Bare mirror of repo_url shared by every workspace
+        name = hashlib.sha1(repo_url).hexdigest()[:12]
+        return os.path.join(self.shared_dir, os.path.basename(
+            repo_url.rstrip('/')).replace('.git', '') + '-' + name + '.git')
+
+    @contextmanager
+    def shared_lock(self, name):
+        # Serialise updates of a shared resource across processes
+        with open(os.path.join(self.shared_dir, name + '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
@@ -87,7 +87,7 @@ setup(
     packages=find_packages(),
     test_suite='nose.collector',
     tests_require=['nose'],
-    install_requires=['fabric', 'PyYaml', 'argparse', 'stevedore', 'sphinx',
+    install_requires=['fabric', 'PyYaml', 'argparse', 'sphinx',
                       'pbr >= 0.10.7', 'six >= 1.9.0'],
     scripts=['bin/calyptos'],
     classifiers=[
@@ -2,4 +2,33 @@ from calyptos.rolebuilder import RoleBuilder
 
 
 def test_constructor():
-    component_deployer = RoleBuilder('etc/environment.yml')
\ No newline at end of file
+    component_deployer = RoleBuilder('etc/environment.yml')
+
+
+def test_host_index():
+    component_deployer = RoleBuilder('etc/environment.yml')
+    host_index = component_deployer.host_index
+    assert host_index['10.113.10.6']['roles'] == set(['node-controller'])
+    assert host_index['10.113.10.6']['clusters'] == set(['one'])
+    assert host_index['10.113.10.1']['clusters'] == set()
+    assert set(host_index) == component_deployer.all_hosts
+
+
+def test_select_hosts():
+    component_deployer = RoleBuilder('etc/environment.yml')
+    select = component_deployer.select_hosts
+    assert select('node-controller & cluster:one') == set(['10.113.10.6'])
+    assert select('clc | walrus') == set(['10.113.10.1', '10.113.10.2'])
+    assert select('cluster:one & !(node-controller, cluster-controller)') == \
+        set(['10.113.10.5'])
+    assert select('10.113.10.3') == set(['10.113.10.3'])
+    try:
+        select('node-controller &')
+        assert False, 'incomplete expression should raise'
+    except ValueError:
+        pass
+
+
+def test_snapshot_of_snapshot():
+    snapshot = RoleBuilder('etc/environment.yml').snapshot()
+    assert snapshot.snapshot() is snapshot
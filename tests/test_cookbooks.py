@@ -0,0 +1,63 @@
+import json
+import os
+import shutil
+import tempfile
+from calyptos.cookbooks import CookbookIndex, recipe_cookbook
+
+
+def test_recipe_cookbook():
+    assert recipe_cookbook('recipe[ceph::mon]') == 'ceph'
+    assert recipe_cookbook('eucalyptus::node-controller') == 'eucalyptus'
+    assert recipe_cookbook('midokura') == 'midokura'
+    assert recipe_cookbook('role[base]') is None
+
+
+def test_closure():
+    directory = tempfile.mkdtemp()
+    try:
+        cookbooks = {'eucalyptus': {'yum': '>= 0.0.0', 'selinux': '>= 0.0.0'},
+                     'yum': {}, 'selinux': {}, 'ceph': {'apt': '>= 0.0.0'},
+                     'apt': {}}
+        for name, dependencies in cookbooks.items():
+            os.mkdir(os.path.join(directory, name))
+            with open(os.path.join(directory, name, 'metadata.json'), 'w') as f:
+                json.dump({'name': name, 'dependencies': dependencies}, f)
+        os.mkdir(os.path.join(directory, 'riak'))
+        with open(os.path.join(directory, 'riak', 'metadata.rb'), 'w') as f:
+            f.write("name 'riak'\ndepends 'yum', '>= 3.0'\ndepends \"ulimit\"\n")
+        index = CookbookIndex(directory)
+        assert index.closure(['eucalyptus::node-controller']) == set(
+            ['eucalyptus', 'yum', 'selinux'])
+        # Cookbooks that are not vendored are ignored
+        assert index.closure(['recipe[riak]']) == set(['riak', 'yum'])
+        assert index.excluded(['eucalyptus::node-controller']) == [
+            'apt', 'ceph', 'riak']
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_vendored_cookbooks_kept():
+    from fabric.api import local
+    from calyptos.chefmanager import ChefManager
+    directory = tempfile.mkdtemp()
+    try:
+        berksfile = os.path.join(directory, 'Berksfile')
+        with open(berksfile, 'w') as handle:
+            handle.write("cookbook 'eucalyptus'\n")
+        local('cd {0} && git init -q && git add Berksfile && git -c '
+              'user.name=t -c user.email=t@t commit -qm init'.format(directory),
+              capture=True)
+        cookbooks = os.path.join(directory, 'cookbooks')
+        os.mkdir(cookbooks)
+        stamp_file = os.path.join(directory, 'cookbooks.stamp')
+        with open(stamp_file, 'w') as stamp:
+            stamp.write(ChefManager.cookbooks_key(berksfile))
+        # Nothing changed, so berks is not run and the cookbooks stay
+        ChefManager.download_cookbooks(berksfile, cookbooks,
+                                       stamp_file=stamp_file)
+        assert os.path.isdir(cookbooks)
+        with open(berksfile + '.lock', 'w') as handle:
+            handle.write('DEPENDENCIES\n')
+        assert ChefManager.cookbooks_key(berksfile) != open(stamp_file).read()
+    finally:
+        shutil.rmtree(directory)
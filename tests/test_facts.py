@@ -0,0 +1,71 @@
+from calyptos.plugins.debugger.facts import HostFacts
+
+SAMPLE_OUTPUT = """@@calyptos-fact sockets
+Proto Recv-Q Send-Q Local Address               Foreign Address             State       PID/Program name
+tcp        0      0 0.0.0.0:8773                0.0.0.0:*                   LISTEN      2215/eucalyptus-clo
+@@calyptos-fact service eucalyptus-cloud
+eucalyptus-cloud (pid  2215) is running...
+@@calyptos-rc 0
+@@calyptos-fact service eucalyptus-nc
+eucalyptus-nc is not running
+@@calyptos-rc 3
+@@calyptos-fact disk
+Filesystem         1024-blocks      Used Available Capacity Mounted on
+/dev/sda1             51475068  46327561   5147507      90% /
+/dev/sdb1            103081248   1030812 102050436       1% /var/lib/eucalyptus
+@@calyptos-fact memory
+             total       used       free     shared    buffers     cached
+Mem:       8061404    5869252    2192152        296     206780    3221376
+-/+ buffers/cache:    2441096    5620308
+Swap:      8159228          0    8159228
+@@calyptos-fact files
+eucalyptus eucalyptus 755 /var/lib/eucalyptus
+root root 755 /var/log/eucalyptus
+"""
+
+
+def test_parse_facts():
+    facts = HostFacts()
+    parsed = facts.parse(SAMPLE_OUTPUT)
+    assert parsed['sockets'] == [['tcp', '0.0.0.0', 8773, '2215/eucalyptus-clo']]
+    assert parsed['services']['eucalyptus-cloud']['running']
+    assert not parsed['services']['eucalyptus-nc']['running']
+    assert parsed['memory']['available'] == 5620308
+    assert parsed['files']['/var/log/eucalyptus']['owner'] == 'root'
+    facts.snapshot['10.0.0.1'] = parsed
+    assert facts.disk_usage('10.0.0.1', '/var/lib/eucalyptus/db')['used_percent'] == 1
+    assert facts.disk_usage('10.0.0.1', '/var/log')['used_percent'] == 90
+
+
+def test_parse_ss_sockets():
+    lines = ['Netid State  Recv-Q Send-Q Local Address:Port Peer Address:Port Process',
+             'udp   UNCONN 0      0      *:53               *:*',
+             'tcp   LISTEN 0      128    [::]:87730         [::]:*  users:(("java",pid=1,fd=3))']
+    sockets = HostFacts()._parse_sockets(lines)
+    assert sockets[0] == ['udp', '*', 53, '']
+    assert sockets[1][2] == 87730
+
+
+def test_recursive_paths():
+    from calyptos.plugins.debugger.file_permissions import FilePermissions
+    config = {'file_permissions': {'node-controller': [
+        {'path': '/var/lib/eucalyptus/instances/', 'recursive': True},
+        {'path': '/etc/eucalyptus'}]}}
+    paths, recursive_paths = FilePermissions.fact_paths(config)
+    assert paths == ['/etc/eucalyptus', '/var/lib/eucalyptus/instances']
+    assert recursive_paths == ['/var/lib/eucalyptus/instances']
+    script = HostFacts(paths=paths, recursive_paths=recursive_paths).script()
+    assert ("find /etc/eucalyptus -xdev -maxdepth 0 " in script)
+    assert ("find /var/lib/eucalyptus/instances -xdev -printf" in script)
+
+
+def test_host_commands():
+    facts = HostFacts(commands={'10.0.0.1': {'db-size': 'du -s /db'}})
+    assert '(du -s /db) 2>&1' in facts.script('10.0.0.1')
+    assert 'du -s /db' not in facts.script('10.0.0.2')
+    parsed = facts.parse('@@calyptos-fact command db-size\n'
+                         '1024\t/db\n@@calyptos-rc 0\n')
+    facts.snapshot['10.0.0.1'] = parsed
+    assert facts.command('10.0.0.1', 'db-size') == {'output': '1024\t/db',
+                                                    'return_code': 0}
+    assert facts.command('10.0.0.1', 'describe-services') is None
@@ -0,0 +1,18 @@
+import os
+import shutil
+import tempfile
+from calyptos.files import content_hash, write_if_changed
+
+
+def test_write_if_changed():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'environment.json')
+        assert write_if_changed(path, '{}\n') == (content_hash('{}\n'), True)
+        os.utime(path, (0, 0))
+        assert write_if_changed(path, '{}\n')[1] is False
+        assert os.path.getmtime(path) == 0
+        assert write_if_changed(path, '{"a": 1}\n')[1] is True
+        assert os.listdir(directory) == ['environment.json']
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,25 @@
+from calyptos.fleet import OutputGroups, stream_command
+
+
+def test_output_groups():
+    groups = OutputGroups()
+    groups.add('10.0.0.1', {'status': 'ok', 'exit_code': 0, 'output': 'up'})
+    groups.add('10.0.0.2', {'status': 'ok', 'exit_code': 0, 'output': 'up'})
+    groups.add('10.0.0.3', {'status': 'failed', 'exit_code': 1, 'output': 'up'})
+    groups.add('10.0.0.4', {'status': 'timeout', 'exit_code': None,
+                            'output': ''})
+    largest = groups.largest_first()
+    assert largest[0]['hosts'] == ['10.0.0.1', '10.0.0.2']
+    assert len(largest) == 3
+    assert groups.histogram == {'exit 0': 2, 'exit 1': 1, 'timeout': 1}
+    assert groups.failed() == 2
+
+
+def test_stream_command_reports_every_host():
+    # Nothing listens on port 1, so every host fails to connect at once
+    hosts = ['127.0.0.1:1', '127.0.0.2:1', '127.0.0.3:1']
+    streamed = dict(stream_command('true', hosts, concurrency=2,
+                                   password='unused'))
+    assert sorted(streamed) == hosts
+    assert set(result['status'] for result in streamed.values()) == set(
+        ['unreachable'])
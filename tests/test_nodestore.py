@@ -0,0 +1,72 @@
+import json
+import os
+import shutil
+import tempfile
+from calyptos.chefmanager import ChefManager, NodeStore
+
+NODE = {'name': 'nc1',
+        'run_list': ['recipe[eucalyptus::node-controller]'],
+        'automatic': {'ipaddress': '10.0.0.6',
+                      'network': {'interfaces': {
+                          'em1': {'addresses': {'10.0.0.6': {},
+                                                '192.168.0.6': {}}}}},
+                      'kernel': {'modules': {}}}}
+
+
+def test_node_store():
+    chef_repo_dir = tempfile.mkdtemp() + '/'
+    try:
+        os.mkdir(chef_repo_dir + 'nodes')
+        store = NodeStore(chef_repo_dir)
+        with open(store.node_file('nc1'), 'w') as node_file:
+            node_file.write(json.dumps(NODE))
+        store.update({'nc1': NodeStore.compact(NODE)})
+        assert 'automatic' not in store['nc1']
+        assert store.node_for_address('192.168.0.6') == 'nc1'
+        assert store.is_current('nc1', os.path.getmtime(store.node_file('nc1')))
+        store['nc1']['run_list'] = []
+        full = store.full('nc1')
+        assert full['run_list'] == []
+        assert full['automatic'] == NODE['automatic']
+        os.utime(store.node_file('nc1'), (1, 1))
+        store.touch('nc1', 1)
+        assert store.is_current('nc1', 1)
+    finally:
+        shutil.rmtree(chef_repo_dir)
+
+
+def test_parse_readiness():
+    assert ChefManager.parse_readiness(
+        'key=1\nrsync=1\nchef=11.16.4\nconverged=0\nenvironment=ab12\n') == {
+        'key': True, 'rsync': True, 'chef_version': '11.16.4',
+        'converged': False, 'environment_hash': 'ab12'}
+    assert ChefManager.parse_readiness('key=0\nrsync=0\nchef=\n') == {
+        'key': False, 'rsync': False, 'chef_version': None,
+        'converged': False, 'environment_hash': None}
+
+
+def test_store_node_file():
+    import base64
+    import gzip
+    import hashlib
+    from StringIO import StringIO
+    from calyptos.chefmanager import store_node_file
+    directory = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(directory, 'nodes'))
+        data = json.dumps(NODE)
+        compressed = StringIO()
+        with gzip.GzipFile(fileobj=compressed, mode='w') as handle:
+            handle.write(data)
+        output = '\n'.join(['nc1', hashlib.md5(data).hexdigest(),
+                            base64.b64encode(compressed.getvalue())])
+        name, compacted = store_node_file(output, 'deployer', directory + '/',
+                                          set())
+        assert name == 'nc1' and 'automatic' not in compacted[0]
+        with open(os.path.join(directory, 'nodes', 'nc1.json')) as handle:
+            assert handle.read() == data
+        # Unchanged and already known
+        assert store_node_file('nc1\nabc\n', 'deployer', directory + '/',
+                               set(['nc1'])) is None
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,54 @@
+import time
+from calyptos.parallel import HostLimiter, map_concurrently
+from calyptos.results import ResultCollector
+
+
+def test_map_concurrently():
+    def square(value):
+        if value == 3:
+            raise ValueError('three')
+        return value * value
+    results = map_concurrently(square, range(5), max_workers=2)
+    assert results[4] == 16
+    assert isinstance(results[3], ValueError)
+    assert len(results) == 5
+
+
+def test_host_limiter_batches():
+    limiter = HostLimiter(2)
+    batches = list(limiter.batches(['a', 'b', 'c']))
+    assert batches == [['a', 'b'], ['c']]
+    with limiter.slots(5) as acquired:
+        assert acquired == 2
+
+
+def test_result_collector_totals():
+    collector = ResultCollector()
+    collector.record('one', 'passed')
+    collector.record('two', 'failed')
+    collector.record('two', 'passed')
+    assert collector.count('two', 'passed') == 1
+    assert collector.totals()['passed'] == 2
+
+
+def test_process_group_limiter():
+    import multiprocessing
+    from calyptos.parallel import ProcessGroupLimiter
+    limiter = ProcessGroupLimiter({'cluster:one': 1})
+    active = multiprocessing.Value('i', 0)
+    peak = multiprocessing.Value('i', 0)
+
+    def work():
+        with limiter.slots(['cluster:one', 'role:unlimited']):
+            with active.get_lock():
+                active.value += 1
+                peak.value = max(peak.value, active.value)
+            time.sleep(0.05)
+            with active.get_lock():
+                active.value -= 1
+    processes = [multiprocessing.Process(target=work) for _ in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert peak.value == 1
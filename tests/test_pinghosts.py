@@ -0,0 +1,49 @@
+import socket
+from calyptos.plugins.validator.pinghosts import PingHosts
+from calyptos.results import ResultCollector
+
+
+class Hosts(object):
+    all_hosts = ['127.0.0.1', '127.0.0.2', '127.0.0.3']
+
+    def read_environment(self):
+        return {}
+
+    def get_roles(self):
+        return {}
+
+
+class LocalPingHosts(PingHosts):
+    # Only 127.0.0.3 answers ICMP, without needing ping installed
+    def _ping(self, host, count=1, timeout=2):
+        return host == '127.0.0.3'
+
+
+def test_ping_hosts():
+    # Only 127.0.0.1 listens on the port, 127.0.0.2 refuses it
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(5)
+    try:
+        config = {'pinghosts': {'port': listener.getsockname()[1],
+                                'timeout': 1, 'concurrency': 3}}
+        collector = ResultCollector()
+        validator = LocalPingHosts(Hosts(), config=config,
+                                   collector=collector)
+        try:
+            validator.validate()
+            assert False, '127.0.0.2 should have been reported'
+        except AssertionError as e:
+            assert str(e) == 'Unable to reach hosts: 127.0.0.2'
+    finally:
+        listener.close()
+    # Every host is reported, with why the unreachable one failed
+    statuses = dict((record['host'], record) for record in collector.records)
+    assert sorted(statuses) == Hosts.all_hosts
+    assert statuses['127.0.0.1']['status'] == 'passed'
+    assert statuses['127.0.0.3']['status'] == 'passed'
+    assert statuses['127.0.0.2']['status'] == 'failed'
+    assert 'no TCP connection' in statuses['127.0.0.2']['message']
+    assert 'no ICMP reply' in statuses['127.0.0.2']['message']
+    assert all(record['duration'] is not None
+               for record in collector.records)
@@ -0,0 +1,46 @@
+from calyptos.planner import Estimator, Stage, run_lists
+
+
+def test_run_lists_accumulate_until_cleared():
+    stages = [Stage('first', ['a'], [(['a', 'b'], ['one'])], clear=True),
+              Stage('second', ['a', 'b'], [(['a'], ['two'])]),
+              Stage('third', ['b'], [(['b'], ['three'])], clear=True)]
+    planned = run_lists(stages, ['a', 'b'])
+    assert planned[0][1] == {'a': ['one']}
+    assert planned[1][1] == {'a': ['one', 'two'], 'b': ['one']}
+    assert planned[2][1] == {'b': ['three']}
+
+
+def test_stage_estimate():
+    estimator = Estimator(recipe_seconds={'slow': 100}, default_recipe_seconds=10,
+                          run_overhead_seconds=0, pool_size=2)
+    host_run_lists = {'a': ['slow'], 'b': ['fast'], 'c': ['fast']}
+    # c and b start first, a waits for a free slot
+    assert estimator.stage_seconds(host_run_lists, ['a', 'b', 'c']) == 110
+    assert estimator.waves(['a', 'b', 'c']) == [['c', 'b'], ['a']]
+
+
+def test_longest_first():
+    estimator = Estimator(recipe_seconds={'slow': 100}, default_recipe_seconds=10,
+                          run_overhead_seconds=0, pool_size=2,
+                          role_seconds={'clc': 500}, host_roles={'c': ['clc']},
+                          role_recipes={'clc': ['fast']},
+                          recorded={('b', ('fast',)): 200})
+    host_run_lists = {'a': ['slow'], 'b': ['fast'], 'c': ['fast'],
+                      'd': ['fast']}
+    # Fabric starts from the end of the list
+    hosts = estimator.longest_first(host_run_lists)
+    assert hosts == ['d', 'a', 'b', 'c']
+    assert estimator.stage_seconds(host_run_lists, hosts) == 500
+
+
+def test_role_weight_only_for_its_recipes():
+    estimator = Estimator(recipe_seconds={'configure': 20},
+                          default_recipe_seconds=10, run_overhead_seconds=5,
+                          role_seconds={'clc': 900}, host_roles={'a': ['clc']},
+                          role_recipes={'clc': ['cloud-controller',
+                                                'register-components']})
+    # A stage unrelated to the role is not charged the role's weight
+    assert estimator.host_seconds('a', ['configure']) == 25
+    assert estimator.host_seconds('a', ['cloud-controller', 'configure']) == 925
+    assert estimator.host_seconds('b', ['cloud-controller']) == 15
@@ -0,0 +1,75 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from calyptos import registry
+
+
+def test_cached_entry_points():
+    cache_dir = tempfile.mkdtemp()
+    cache_file = registry.CACHE_FILE
+    registry.CACHE_FILE = os.path.join(cache_dir, 'plugins.json')
+    try:
+        scanned = registry.entry_points('calyptos.validator')
+        assert ['topology', 'calyptos.plugins.validator.topology:Topology'] in scanned
+        assert os.path.isfile(registry.CACHE_FILE)
+        # A cache hit does not scan the installed distributions again
+        scan = registry._scan_entry_points
+        registry._scan_entry_points = None
+        try:
+            assert registry.entry_points('calyptos.validator') == scanned
+        finally:
+            registry._scan_entry_points = scan
+        mgr = registry.extension_manager('calyptos.validator',
+                                         names=['topology'],
+                                         invoke_args=(RoleStub(),))
+        assert mgr.names() == ['topology']
+        # Nor does it import pkg_resources or stevedore
+        script = ('import sys; from calyptos import registry; '
+                  'registry.CACHE_FILE = %r; '
+                  "registry.plugin_class('calyptos.validator', 'topology'); "
+                  "print sorted(m for m in sys.modules "
+                  "if m.split('.')[0] in ('pkg_resources', 'stevedore'))"
+                  % registry.CACHE_FILE)
+        cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        # The first run caches the entry points for its own sys.path
+        subprocess.check_output([sys.executable, '-c', script], cwd=cwd)
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=cwd)
+        assert output.strip() == '[]'
+    finally:
+        registry.CACHE_FILE = cache_file
+        shutil.rmtree(cache_dir)
+
+
+class RoleStub(object):
+    def read_environment(self):
+        return {}
+
+    def get_roles(self):
+        return {}
+
+
+class Counting(object):
+    created = []
+
+    def __init__(self, name):
+        Counting.created.append(name)
+
+
+def test_only_moved_plugins_retried():
+    target = __name__ + ':Counting'
+    scans = {False: [['kept', target], ['moved', 'calyptos.missing:Gone']],
+             True: [['kept', target], ['moved', target]]}
+    entry_points = registry.entry_points
+    registry.entry_points = lambda namespace, refresh=False: scans[refresh]
+    try:
+        del Counting.created[:]
+        loaded = registry._load_extensions('calyptos.test', None,
+                                           ('x',), {})
+        assert sorted(ext.name for ext in loaded) == ['kept', 'moved']
+        # The plugin that loaded from the cache is not built again
+        assert len(Counting.created) == 2
+    finally:
+        registry.entry_points = entry_points
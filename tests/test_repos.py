@@ -0,0 +1,92 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import os
+import shutil
+import tempfile
+import threading
+import time
+from calyptos.plugins.validator.repos import Repos
+
+REPOMD = """<?xml version="1.0" encoding="UTF-8"?>
+<repomd xmlns="http://linux.duke.edu/metadata/repo">
+  <data type="primary"><timestamp>{0}</timestamp></data>
+</repomd>
+"""
+
+
+class RepoHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def _respond(self, body):
+        RepoHandler.requests.append((self.command, self.path))
+        if self.path == '/moved/':
+            self.send_response(302)
+            self.send_header('Location', '/repo/')
+            self.end_headers()
+        elif self.path == '/bare/' or self.path.startswith('/repo/'):
+            self.send_response(200)
+            self.end_headers()
+            if body and self.path.endswith('repomd.xml'):
+                self.wfile.write(REPOMD.format(int(time.time()) - 86400))
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def do_GET(self):
+        self._respond(True)
+
+    def log_message(self, *args):
+        pass
+
+
+class RepoEnvironment(object):
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def read_environment(self):
+        return {'default_attributes': {'eucalyptus': {
+            'eucalyptus-repo': self.base_url + '/repo/',
+            'euca2ools-repo': self.base_url + '/moved/',
+            'enterprise-repo': self.base_url + '/bare/',
+            'init-script-url': self.base_url + '/missing.sh'}}}
+
+    def get_roles(self):
+        return {}
+
+
+def test_repos_validate():
+    server = HTTPServer(('127.0.0.1', 0), RepoHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    cache_dir = tempfile.mkdtemp()
+    try:
+        base_url = 'http://127.0.0.1:{0}'.format(server.server_port)
+        config = {'repos': {'cache_file': os.path.join(cache_dir, 'repos.json')}}
+        validator = Repos(RepoEnvironment(base_url), config=config)
+        try:
+            validator.validate()
+            assert False, 'missing.sh should have been reported'
+        except AssertionError as e:
+            assert 'missing.sh' in str(e)
+            assert '/repo/' not in str(e)
+            # A repo without metadata fails, a redirected one is followed
+            assert 'UNREADABLE REPO METADATA: ' + base_url + '/bare/' in str(e)
+            assert '/moved/' not in str(e)
+        # Reachability checks never downloaded a body
+        assert ('GET', '/moved/') not in RepoHandler.requests
+        assert ('HEAD', '/repo/') in RepoHandler.requests
+        # A second run answers the good URLs from the cache
+        del RepoHandler.requests[:]
+        try:
+            validator.validate()
+        except AssertionError:
+            pass
+        assert ('HEAD', '/repo/') not in RepoHandler.requests
+        # and reuses the metadata read through the redirect
+        assert ('GET', '/repo/repodata/repomd.xml') not in RepoHandler.requests
+    finally:
+        server.shutdown()
+        shutil.rmtree(cache_dir)
@@ -0,0 +1,31 @@
+from StringIO import StringIO
+from xml.etree import ElementTree
+import json
+from calyptos.results import ResultCollector
+
+
+def test_json_lines_and_junit():
+    stream = StringIO()
+    collector = ResultCollector(stream)
+    collector.record('CheckPorts', 'passed', '10.0.0.1: Open tcp/22',
+                     host='10.0.0.1', check='Open tcp/22', duration=0.25)
+    collector.record('CheckPorts', 'failed', '10.0.0.2: Closed tcp/22',
+                     host='10.0.0.2', check='Closed tcp/22')
+    collector.record('Repos', 'warnings', 'Repo metadata is 40 days old')
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [r['status'] for r in records] == ['passed', 'failed', 'warnings']
+    assert records[1]['host'] == '10.0.0.2'
+    assert records[2]['check'] == 'Repo metadata is 40 days old'
+    # Only measured checks have a duration
+    assert records[0]['duration'] == 0.25
+    assert records[1]['duration'] is None
+    junit = StringIO()
+    collector.write_junit(junit)
+    suites = ElementTree.fromstring(junit.getvalue())
+    check_ports = suites.find("testsuite[@name='CheckPorts']")
+    assert check_ports.get('tests') == '2'
+    assert check_ports.get('failures') == '1'
+    assert len(suites.findall('.//failure')) == 1
+    cases = check_ports.findall('testcase')
+    assert cases[0].get('time') == '0.250'
+    assert cases[1].get('time') is None
@@ -0,0 +1,134 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from fabric.api import settings
+from fabric.state import connections
+from calyptos.plugins.debugger.eucalyptus_sosreports import (
+    EucalyptusSosReports, download_sosreport)
+from calyptos.results import ResultCollector
+
+HOST = '10.0.0.1'
+REPORT = ''.join(chr(index % 256) for index in range(300000))
+
+
+class RemoteFile(object):
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+        self.position = 0
+
+    def seek(self, offset):
+        self.offsets.append(offset)
+        self.position = offset
+
+    def read(self, size):
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+    def close(self):
+        pass
+
+
+class RemoteHost(object):
+    # Stands in for the SSH connection, serving the sosreport over SFTP
+    def __init__(self, data):
+        self.data = data
+        self.offsets = []
+
+    def open_sftp(self):
+        return self
+
+    def open(self, path, mode):
+        return RemoteFile(self.data, self.offsets)
+
+    def close(self):
+        pass
+
+
+def download(local_path, md5, retries=3):
+    remote = RemoteHost(REPORT)
+    with settings(host_string=HOST, host=HOST, user='root'):
+        connections[HOST] = remote
+        # Retries reconnect, to the same stand in
+        connections.connect = lambda key: connections.__setitem__(key,
+                                                                  remote)
+        try:
+            result = download_sosreport(
+                {HOST: '/tmp/sosreport.tar.xz'}, {HOST: local_path},
+                {HOST: len(REPORT)}, {HOST: md5}, retries=retries)
+        finally:
+            del connections.connect
+            del connections[HOST]
+    return result, remote.offsets
+
+
+def test_download_resumes_from_partial_file():
+    directory = tempfile.mkdtemp()
+    try:
+        local_path = os.path.join(directory, 'sosreport.tar.xz')
+        with open(local_path + '.part', 'wb') as partial:
+            partial.write(REPORT[:1000])
+        result, offsets = download(local_path, hashlib.md5(REPORT).hexdigest())
+        assert result == {'verified': True, 'resumed_from': 1000}
+        assert offsets == [1000]
+        with open(local_path, 'rb') as local_file:
+            assert local_file.read() == REPORT
+        assert not os.path.exists(local_path + '.part')
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_download_checksum_mismatch():
+    directory = tempfile.mkdtemp()
+    try:
+        local_path = os.path.join(directory, 'sosreport.tar.xz')
+        result, offsets = download(local_path, 'not the md5', retries=2)
+        assert result == {'verified': False, 'resumed_from': 0}
+        # A corrupt download is started over rather than resumed
+        assert offsets == [0, 0]
+        assert os.listdir(directory) == []
+    finally:
+        shutil.rmtree(directory)
+
+
+class DeployerStub(object):
+    all_hosts = [HOST]
+
+    def read_environment(self):
+        return {}
+
+    def get_roles(self):
+        return {'all': [HOST]}
+
+
+def test_disk_space_guard_without_directory():
+    collector = ResultCollector()
+    plugin = EucalyptusSosReports(DeployerStub(), collector=collector)
+    assert not plugin._enough_disk_space('/nonexistent/sosreport-dir',
+                                         {HOST: 'report'}, {HOST: 10}, 0)
+    assert collector.count(plugin.name, 'failed') == 1
+
+
+def test_archive_sosreports():
+    import tarfile
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp()
+    try:
+        os.chdir(directory)
+        os.mkdir('sosreport-1')
+        with open('sosreport-1/10_0_0_1-report.tar.xz', 'wb') as report:
+            report.write('report')
+        plugin = EucalyptusSosReports(DeployerStub(),
+                                      collector=ResultCollector())
+        plugin._archive_sosreports('sosreport-1', [
+            {'host': HOST, 'file': '10_0_0_1-report.tar.xz', 'size': 6,
+             'md5': hashlib.md5('report').hexdigest()}])
+        archive = tarfile.open('sosreport-1.tar')
+        assert sorted(archive.getnames()) == ['10_0_0_1-report.tar.xz',
+                                              'index.json']
+        assert os.listdir('sosreport-1') == []
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
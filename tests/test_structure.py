@@ -0,0 +1,36 @@
+from StringIO import StringIO
+import yaml
+from calyptos.plugins.validator.envschema import find_violations, line_numbers
+from calyptos.plugins.validator.structure import COMPILED_SCHEMA
+
+BROKEN_ENVIRONMENT = """name: broken
+description: 2
+default_attributes:
+  eucalyptus:
+    network:
+      mode: EDGE
+    topology:
+      clc-1: 10.0.0.1
+      user-facing: [10.0.0.2]
+      clusters: {}
+      nodes: 10.0.0.3
+    eucalyptus-repo: http://example.com/
+    euca2ools-repo: http://example.com/
+"""
+
+
+def test_valid_environment():
+    with open('etc/environment.yml') as env_file:
+        environment = yaml.safe_load(env_file)
+    assert find_violations(COMPILED_SCHEMA, environment) == []
+
+
+def test_all_violations_with_lines():
+    violations = find_violations(COMPILED_SCHEMA,
+                                 yaml.safe_load(BROKEN_ENVIRONMENT))
+    lines = line_numbers(StringIO(BROKEN_ENVIRONMENT))
+    found = dict((path, lines[path]) for path, message in violations)
+    assert found[('description',)] == 2
+    assert found[('default_attributes', 'eucalyptus', 'network')] == 5
+    assert found[('default_attributes', 'eucalyptus', 'topology', 'nodes')] == 11
+    assert len(violations) == 3
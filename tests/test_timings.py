@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+from calyptos.timings import TimingDatabase, percentile
+
+
+def test_percentile():
+    assert percentile([], 0.5) is None
+    assert percentile([3, 1, 2], 0.5) == 2
+    assert percentile(range(1, 101), 0.9) == 90
+
+
+def test_timing_database():
+    directory = tempfile.mkdtemp()
+    try:
+        timings = TimingDatabase(os.path.join(directory, 'timings.db'))
+        run_id = timings.start_run('staging', 'provision', 'euca-4.2')
+        timings.record_hosts(run_id, 'provision', [
+            ('10.0.0.1', set(['clc']), ['eucalyptus::cloud-controller'],
+             0, 600, 'passed'),
+            ('10.0.0.6', set(['node-controller']),
+             ['eucalyptus::node-controller'], 0, 300, 'failed')])
+        timings.finish_run(run_id, 'passed')
+        recorded = timings.host_seconds('staging')
+        assert recorded == {('10.0.0.1', ('eucalyptus::cloud-controller',)): 600}
+        assert timings.recent_runs()[0][6] == 'passed'
+        assert timings.branch_trends()[0][:3] == ('provision', 'euca-4.2', 1)
+        timings.record_pushes('staging', run_id, 'provision', [
+            ('10.0.0.1', 1000, 0, 2, 6, 4000, None),
+            ('10.0.0.1', 100, 5, 1, 6, 100, None),
+            ('10.0.0.1', 4000, 9, 40, 0, 4000, 100)])
+        # Measured from the uncompressed size of uncapped pushes
+        assert timings.push_rates('staging', min_bytes=1000) == {
+            '10.0.0.1': 2000}
+        timings.close()
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,30 @@
+from calyptos.plugins.validator.topology import Topology
+
+
+class TopologyStub(object):
+    host_index = {'10.0.0.2': {'roles': set(['cluster-controller']),
+                               'clusters': set(['one', 'two'])},
+                  '10.0.0.3': {'roles': set(['cluster-controller',
+                                             'node-controller']),
+                               'clusters': set(['one'])}}
+
+    def read_environment(self):
+        return {'default_attributes': {'eucalyptus': {'topology': {
+            'clc-1': '10.0.0.1', 'walrus': '10.0.0.1',
+            'clusters': {'one': {'cc-1': '10.0.0.2', 'sc-1': '10.0.0.2',
+                                 'nodes': '10.0.0.3'}}}}}}
+
+    def get_roles(self):
+        return {'clc': ['10.0.0.1'], 'user-facing': ['10.0.0.1'],
+                'walrus': ['10.0.0.1']}
+
+
+def test_every_violation_is_reported():
+    validator = Topology(TopologyStub())
+    try:
+        validator.validate()
+        assert False, 'the topology should have failed'
+    except AssertionError as e:
+        assert 'multiple clusters: 10.0.0.2' in str(e)
+        assert 'conflicting roles: 10.0.0.3' in str(e)
+    assert validator.collector.count('Topology', 'failed') == 2
@@ -0,0 +1,25 @@
+from calyptos.transfer import TransferPolicy, format_bytes, transfer_stats
+
+
+def test_transfer_stats():
+    assert transfer_stats('Number of files: 3\n'
+                          'Total transferred file size: 4,000,000 bytes\n'
+                          'Total bytes sent: 1,234,567\n'
+                          'Total bytes received: 35\n') == (1234567, 4000000)
+    assert transfer_stats('Total bytes sent: 980\n') == (980, None)
+    assert transfer_stats('') == (None, None)
+    assert format_bytes(980) == '980B'
+    assert format_bytes(3 * 1024 * 1024) == '3.0MB'
+
+
+def test_transfer_options():
+    policy = TransferPolicy(auto_compress_below_kib_per_sec=1024,
+                            aggregate_bwlimit_kib_per_sec=10000,
+                            bwlimit_kib_per_sec=4000)
+    options = policy.options(['lan', 'wan', 'new'],
+                             {'lan': 50 * 1024 * 1024, 'wan': 200 * 1024})
+    assert options['lan'] == {'compress_level': 0, 'bwlimit': 3333}
+    assert options['wan']['compress_level'] == 6
+    assert options['new']['compress_level'] == 1
+    assert TransferPolicy(compression=False).options(['a'], {}) == {
+        'a': {'compress_level': 0, 'bwlimit': None}}
@@ -0,0 +1,38 @@
+import json
+import os
+import shutil
+import tempfile
+from calyptos.workspace import Workspace
+
+
+def test_workspaces_are_isolated():
+    base_dir = tempfile.mkdtemp()
+    try:
+        staging = Workspace('staging', base_dir)
+        prod = Workspace('prod', base_dir)
+        assert staging.chef_repo_dir != prod.chef_repo_dir
+        assert staging.remote_folder_path != prod.remote_folder_path
+        repo = 'https://github.com/eucalyptus/eucalyptus-cookbook'
+        assert staging.mirror_path(repo) == prod.mirror_path(repo)
+        with staging.shared_lock('cookbooks'):
+            assert os.path.isdir(staging.root)
+    finally:
+        shutil.rmtree(base_dir)
+
+
+def test_import_legacy_nodes():
+    base_dir = tempfile.mkdtemp()
+    try:
+        legacy = os.path.join(base_dir, 'chef-repo')
+        os.makedirs(os.path.join(legacy, 'nodes'))
+        for name, environment in (('clc', 'staging'), ('other', 'prod')):
+            with open(os.path.join(legacy, 'nodes', name + '.json'), 'w') as f:
+                json.dump({'name': name, 'chef_environment': environment}, f)
+        staging = Workspace('staging', os.path.join(base_dir, 'workspaces'))
+        imported = staging.import_legacy_nodes(legacy)
+        assert [os.path.basename(path) for path in imported] == ['clc.json']
+        assert os.listdir(staging.nodes_dir) == ['clc.json']
+        # Only an empty workspace is seeded
+        assert staging.import_legacy_nodes(legacy) == []
+    finally:
+        shutil.rmtree(base_dir)